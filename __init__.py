@@ -16,7 +16,7 @@ bl_info = {
     "description": "undo the vertex",
     "author": "Yuuzen401",
     "version": (0, 0, 18),
-    "blender": (2, 80, 0),
+    "blender": (3, 0, 0),
     "location":  "Mesh Edit > Sidebar > Undo Vertices",
     "warning": "",
     "wiki_url": "",
@@ -30,12 +30,12 @@ import bmesh
 from bpy.types import Operator, Panel
 from pprint import pprint
 from .helper import *
-from .usecase import get_curve_map_locations, get_distance
 from .preferences import *
 from .exception import *
 from .mesh_helpers import *
 from .grease_pencil_helpers import *
-from .undo_vertices import UndoVertices
+from .undo_vertices import UndoVertices, stamp_vertex_ids
+from .snapshot import VerticesSnapshot
 from .view_operator import *
 from .undo_operator import *
 from .prop import UndoVerticesPropertyGroup
@@ -45,87 +45,52 @@ class UndoVerticesSaveOperator(Operator, UndoVertices):
     bl_label = "Save vertices"
     bl_options = {"REGISTER", "UNDO"}
 
-    draw_handler = None
-
     def execute(self, context):
-        obj = context.active_object
-        bm = bmesh_from_object(obj)
-        selected_verts = UndoVertices.get_selected_verts(bm)
+        # 編集中の全てのオブジェクトから全頂点の選択状態と座標をまとめて読み込む
+        targets = []
+        for obj in UndoVertices.get_target_objects(context):
+            mask = get_verts_select_array(obj)
+            if mask.any():
+                me = obj.data
+                # 頂点の削除や並べ替えの後も対応させられるよう、保存する頂点に識別子を付与する
+                ids = stamp_vertex_ids(obj, mask)
+                targets.append((obj, mask, get_verts_array(me, "co"), get_verts_array(me, "normal"), get_edges_array(me), obj.matrix_world.copy(), ids))
 
         # 未選択の場合
-        if 1 > len(selected_verts):
+        if 1 > len(targets):
             show_message_error("頂点が選択されていません。")
             return {"CANCELLED"}
 
-        UndoVertices.set_selected_verts(selected_verts)
-        # UndoVertices.set_selected_coords(bm, obj)
-        UndoVertices.save_all_len = len(bm.verts)
-        # UndoVertices.save_to_annotation(context)
-
-        # 保存した頂点で再選択して更新してからBMをコピーする
-        bm.verts.ensure_lookup_table()
-        for v in bm.verts:
-            v.select = False
-        for v in self.save_selected_verts:
-            index = v[2]
-            bm.verts[index].select = True
-
-        bm.select_flush_mode()
-        bmesh.update_edit_mesh(obj.data)
-
-        # モディファイア適用無の状態で保存
-        bm_copy = bmesh_copy_from_object(obj, True, False, False)
-        for v in bm_copy.verts:
-            if v.select == False :
-                bm_copy.verts.remove(v)
-        bm_copy.verts.index_update()
-        UndoVertices.save_bm = bm_copy
-
-        # モディファイア適用有の状態で保存
-        bm_copy = bmesh_copy_from_object(obj, True, False, True)
-        for v in bm_copy.verts:
-            if v.select == False :
-                bm_copy.verts.remove(v)
-        bm_copy.verts.index_update()
-        UndoVertices.save_bm_mod = bm_copy
+        # 保存した頂点とその間の辺だけをワールド座標で保存する（モディファイア適用無）
+        # 配列の処理はオブジェクトごとにスレッドで並列に行う
+        snapshots = run_in_thread_pool(lambda target: VerticesSnapshot.create(*target[1:]), targets)
+        for target, snapshot in zip(targets, snapshots):
+            UndoVertices.set_selected_verts(context, snapshot, target[0])
+
+        # モディファイア適用有の形状は、表示の設定に関係なく編集される前に次のタイマーで作成しておく
+        # 保存後に編集すると保存時の形状を再現できず、後から表示を有効にしても作成できないため
+        for target in targets:
+            UndoVertices.request_geometry_mod(obj = target[0])
 
         area_3d_view_tag_redraw_all()
-        UndoVertices.active_obj_name = obj.name
-        self.__handle_add(context)
         return {"FINISHED"}
 
-    @classmethod
-    def __handle_add(self, context):
-        if self.draw_handler is None :
-            self.draw_handler = bpy.types.SpaceView3D.draw_handler_add(self.__draw, (context, ), "WINDOW", "POST_VIEW")
-
-    @classmethod
-    def __handle_remove(self, context):
-        bpy.types.SpaceView3D.draw_handler_remove(self.draw_handler, "WINDOW")
-        self.draw_handler = None
-
-    @classmethod
-    def __draw(self, context):
-        now_active_name = context.active_object.name
-        if UndoVertices.active_obj_name != now_active_name:
-            UndoVertices.reset_save(context)
-            UndoVerticesUndoOperator.remove_working_temporary_modifier()
-            self.__handle_remove(context)
-            area_3d_view_tag_redraw_all()
-
-        elif context.mode != "EDIT_MESH":
-            UndoVerticesUndoOperator.remove_working_temporary_modifier()
-
 class UndoVerticesSelectOperator(Operator, UndoVertices):
     bl_idname = "select_verts.operator"
     bl_label = "Save vertices select"
 
     def execute(self, context):
-        # 頂点数が減っている場合はキャンセルする
-        if UndoVertices.is_len_diff() == False:
+        # 保存データを現在の頂点に対応させられたオブジェクトのみ選択する
+        targets = [(obj, UndoVertices.resolve_snapshot(context, obj, self.report)) for obj in UndoVertices.get_target_objects(context)]
+        targets = [(obj, snapshot) for obj, snapshot in targets if snapshot is not None]
+        if 1 > len(targets):
             show_message_error("頂点数が増減した場合、選択できません。")
             return {"CANCELLED"}
-        UndoVertices.select_save_verts(context, bpy.context.active_object)
+        # 保存した頂点のみ選択する場合は、選択の解除を編集中の全てのメッシュに対してまとめて行い、保存した頂点だけを書き込む
+        if context.scene.undo_vertices_prop.select == "SELECT_SET" and context.mode == "EDIT_MESH":
+            bpy.ops.mesh.select_all(action = "DESELECT")
+        for obj, snapshot in targets:
+            UndoVertices.select_save_verts(context, obj, snapshot)
         return{"FINISHED"}
 
 class UndoVerticesResetOperator(Operator, UndoVertices):
@@ -133,10 +98,60 @@ class UndoVerticesResetOperator(Operator, UndoVertices):
     bl_label = "Save vertices reset"
 
     def execute(self, context):
-        UndoVertices.reset_save(context)
+        for obj in UndoVertices.get_target_objects(context):
+            UndoVertices.reset_save(context, obj)
         UndoVerticesUndoOperator.remove_working_temporary_modifier()
         return{"FINISHED"}
 
+class UndoVerticesCombineOperator(Operator, UndoVertices):
+    bl_idname = "combine_verts.operator"
+    bl_label = "Combine saved vertices"
+
+    def execute(self, context):
+        prop = context.scene.undo_vertices_prop
+        slots = (prop.save_slot, prop.combine_slot)
+        count = 0
+        combined = []
+        for obj in UndoVertices.get_target_objects(context):
+            # 両方のスロットの保存データを現在の頂点に対応させる（保存していないスロットは空の集合とみなす）
+            snapshots = []
+            for slot in slots:
+                if UndoVertices.get_snapshot(context, obj, slot) is None:
+                    snapshots.append(None)
+                    continue
+                snapshot = UndoVertices.resolve_snapshot(context, obj, self.report, slot)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                else:
+                    self.report({"WARNING"}, "保存した頂点に対応する頂点が無いため組み合わせられません : " + obj.name)
+                    break
+            if len(snapshots) < len(slots) or all(snapshot is None for snapshot in snapshots):
+                continue
+
+            # 集合の演算は配列で行い、表示用の形状に使う辺だけをメッシュから読み込む
+            if obj.mode == "EDIT":
+                obj.update_from_editmode()
+            me = obj.data
+            snapshot = VerticesSnapshot.combine(*snapshots, prop.combine_operation, get_edges_array(me), obj.matrix_world.copy(), len(me.vertices))
+            if len(snapshot) > 0:
+                UndoVertices.set_selected_verts(context, snapshot, obj, prop.combine_result_slot)
+                combined.append(obj)
+            else:
+                UndoVertices.store.remove(UndoVertices.get_slot_key(context, obj, slot = prop.combine_result_slot))
+            count += 1
+
+        if count == 0:
+            show_message_error("保存した頂点がありません。")
+            return {"CANCELLED"}
+
+        # 組み合わせた結果をそのまま選択や元に戻す対象にする
+        prop.save_slot = prop.combine_result_slot
+        # モディファイア適用有の形状は、保存時と同じく次のタイマーで作成する
+        for obj in combined:
+            UndoVertices.request_geometry_mod(obj = obj)
+        area_3d_view_tag_redraw_all()
+        return {"FINISHED"}
+
 class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
     bl_label = "Undo Vertices"
     bl_space_type = "VIEW_3D"
@@ -150,13 +165,15 @@ class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
 
     def draw(self, context):
         prop = context.scene.undo_vertices_prop
-        bm = bmesh.from_edit_mesh(bpy.context.active_object.data)
         layout = self.layout
+        is_len_diff = UndoVertices.is_len_diff()
 
         # Save
         box = layout.box()
         box.label(text = "Save and Undo vertices")
         row = box.row()
+        row.prop(prop, "save_slot")
+        row = box.row()
         row.scale_y = 2
         col = row.column()
         col.operator(UndoVerticesSaveOperator.bl_idname, text = "Save" , text_ctxt = "Save")
@@ -165,7 +182,7 @@ class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
         # Undo
         if UndoVertices.is_save() == False:
             col.enabled = False
-        elif len(bm.verts) != UndoVertices.save_all_len:
+        elif is_len_diff == False:
             col.alert = True
         col.operator(UndoVerticesUndoOperator.bl_idname, text = "Undo" , text_ctxt = "Undo")
 
@@ -175,6 +192,40 @@ class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
             box.label(text = "saved vertices : " + str(UndoVertices.get_len_save_verts()))
             box.operator(UndoVerticesResetOperator.bl_idname, text = "Reset Save" , text_ctxt = "Reset Save")
 
+        # 頂点数が増減した場合に現在の頂点に対応させ直すか
+        row = box.row(align = True)
+        row.prop(prop, "is_remap", text = "Remap")
+        sub = row.row(align = True)
+        sub.enabled = prop.is_remap
+        sub.prop(prop, "remap_distance", text = "Distance")
+
+        # 保存済のスロットの一覧
+        slots = UndoVertices.get_object_slots(context)
+        if len(slots) > 0:
+            col = box.column(align = True)
+            col.scale_y = 0.8
+            for key, count, nbytes, shared in sorted(slots):
+                text = "Slot %d : %d verts  %.1f MB" % (key, count, nbytes / (1024 * 1024))
+                if shared > 0:
+                    text += "  (shared %.1f MB)" % (shared / (1024 * 1024))
+                col.label(text = text, icon = "LAYER_ACTIVE" if key == prop.save_slot else "LAYER_USED")
+            col.label(text = "Total : %.1f MB" % (UndoVertices.store.nbytes / (1024 * 1024)))
+
+        # Combine
+        layout.separator()
+        box = layout.box()
+        box.label(text = "Combine saved vertices")
+        row = box.row(align = True)
+        row.prop_enum(prop, "combine_operation", "UNION")
+        row.prop_enum(prop, "combine_operation", "INTERSECT")
+        row.prop_enum(prop, "combine_operation", "DIFFERENCE")
+        row = box.row(align = True)
+        row.prop(prop, "combine_slot", text = "With")
+        row.prop(prop, "combine_result_slot", text = "To")
+        col = box.column()
+        col.scale_y = 1.5
+        col.operator(UndoVerticesCombineOperator.bl_idname, text = "Combine")
+
         # Select
         layout.separator()
         box = layout.box()
@@ -190,7 +241,7 @@ class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
         col.scale_y = 2
         if UndoVertices.is_save() == False:
             col.enabled = False
-        elif UndoVertices.is_len_diff() == False:
+        elif is_len_diff == False:
             col.alert = True
         col.operator(UndoVerticesSelectOperator.bl_idname, text = "Save To Select ") 
 
@@ -212,6 +263,12 @@ class VIEW3D_PT_UndoVerticesPanel(Panel, UndoVertices):
         row = box.row()
         row.scale_y = 1.5
         row.prop(prop, "is_modifier", text = "Modifiers when saved", icon = "MODIFIER")
+        # 保存後に頂点や選択状態が変わり、モディファイア適用有の形状を作れない場合
+        snapshot = UndoVertices.get_snapshot(context)
+        if prop.is_modifier and snapshot is not None and snapshot.geometry_mod is None:
+            col = box.column(align = True)
+            col.label(text = "Modifier shape not available,", icon = "ERROR")
+            col.label(text = "restore the saved verts and selection")
 
 classes = (
     UndoVerticesPropertyGroup,
@@ -219,6 +276,7 @@ classes = (
     UndoVerticesSaveOperator,
     UndoVerticesSelectOperator,
     UndoVerticesResetOperator,
+    UndoVerticesCombineOperator,
     # UndoVerticesUndoOperator,
     # UndoVerticesViewOperator,
     UndoVerticesPreferences,
@@ -233,6 +291,7 @@ def register():
     bpy.types.Scene.undo_vertices_prop = bpy.props.PointerProperty(type = UndoVerticesPropertyGroup)
     view_operator.register()
     undo_operator.register()
+    undo_vertices.register()
 
 def unregister():
     for cls in classes:
@@ -242,6 +301,7 @@ def unregister():
     addon_updater_ops.unregister()
     view_operator.unregister()
     undo_operator.unregister()
+    undo_vertices.unregister()
 
 if __name__ == "__main__":
     register()
\ No newline at end of file
@@ -0,0 +1,205 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""UndoVerticesの処理時間を計測するベンチマーク
+
+生成した格子状のメッシュで、保存・元に戻す・選択などの処理時間を頂点数ごとに計測し、結果をJSONで出力する
+バックグラウンドのBlenderで実行する
+
+    blender -b --factory-startup --python benchmarks/bench_undo_vertices.py -- --sizes 10000 100000 --output result.json
+
+バージョン間で結果を比較する場合は、同じ頂点数と繰り返し回数で実行すること
+"""
+
+import argparse
+import importlib
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+import bpy
+import numpy as np
+
+# アドオンのフォルダの親をパスに追加し、アドオンをパッケージとして読み込む
+addon_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(addon_dir))
+addon = importlib.import_module(os.path.basename(addon_dir))
+
+usecase = importlib.import_module(addon.__name__ + ".usecase")
+mesh_helpers = importlib.import_module(addon.__name__ + ".mesh_helpers")
+undo_vertices = importlib.import_module(addon.__name__ + ".undo_vertices")
+
+UndoVertices = undo_vertices.UndoVertices
+
+DEFAULT_SIZES = [10000, 100000, 500000, 1000000, 2000000]
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description = "Benchmark the UndoVertices hot paths on generated meshes.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = DEFAULT_SIZES, help = "vertex counts of the generated meshes")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per measurement")
+    parser.add_argument("--ratio", type = float, default = 0.5, help = "ratio of saved (selected) vertices")
+    parser.add_argument("--output", default = None, help = "JSON file to write (stdout when omitted)")
+    return parser.parse_args(argv)
+
+def create_grid_mesh(size):
+    """頂点数が size 以上の格子状のメッシュを作る"""
+    side = max(2, math.ceil(math.sqrt(size)))
+    x, y = np.meshgrid(np.arange(side, dtype = np.float32), np.arange(side, dtype = np.float32))
+    co = np.stack([x.ravel(), y.ravel(), np.zeros(side * side, dtype = np.float32)], axis = 1) / side
+
+    # 四角形の面の頂点インデックス
+    i = np.arange(side - 1)
+    corner = (i[None, :] + i[:, None] * side).ravel()
+    loops = np.stack([corner, corner + 1, corner + side + 1, corner + side], axis = 1).astype(np.int32)
+
+    me = bpy.data.meshes.new("UndoVerticesBench")
+    me.from_pydata(co.tolist(), [], loops.tolist())
+    me.update()
+    return me
+
+def create_object(size, ratio):
+    """計測用のオブジェクトを作り、先頭から ratio の割合の頂点を選択する"""
+    me = create_grid_mesh(size)
+    obj = bpy.data.objects.new("UndoVerticesBench", me)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    mask = np.zeros(len(me.vertices), dtype = bool)
+    mask[:int(len(mask) * ratio)] = True
+    mesh_helpers.set_verts_select_array(obj, mask)
+    return obj
+
+def remove_object(obj):
+    me = obj.data
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(me)
+    UndoVertices.store.clear()
+
+def set_mode(mode):
+    if bpy.context.object.mode != mode:
+        bpy.ops.object.mode_set(mode = mode)
+
+def move_verts(obj, offset = 0.01):
+    """保存後に頂点を動かす（元に戻す処理で変化量があるようにする）"""
+    mode = obj.mode
+    set_mode("OBJECT")
+    co = mesh_helpers.get_verts_array(obj.data, "co")
+    rng = np.random.default_rng(0)
+    co += rng.normal(scale = offset, size = co.shape).astype(np.float32)
+    mesh_helpers.set_verts_co_array(obj.data, co)
+    set_mode(mode)
+
+def measure(func, repeat, setup = None):
+    """func を repeat 回実行し、それぞれの処理時間 (秒) を返す（setup は計測に含めない）"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def run_size(size, args, results):
+    obj = create_object(size, args.ratio)
+    prop = bpy.context.scene.undo_vertices_prop
+    verts_len = len(obj.data.vertices)
+    saved_len = int(verts_len * args.ratio)
+    rng = np.random.default_rng(0)
+
+    def record(name, times, **extra):
+        result = {
+            "name" : name,
+            "size" : verts_len,
+            "saved" : saved_len,
+            "min" : min(times),
+            "median" : statistics.median(times),
+            "runs" : times,
+        }
+        result.update(extra)
+        results.append(result)
+        print("%-28s %9d verts  min %.4f s  median %.4f s" % (name, verts_len, result["min"], result["median"]), file = sys.stderr)
+
+    set_mode("EDIT")
+
+    # 保存
+    record("get_selected_verts", measure(lambda: UndoVertices.get_selected_verts(obj), args.repeat))
+    record("save_operator", measure(lambda: bpy.ops.save_verts.operator(), args.repeat))
+
+    # 配列の計算のみ
+    save_co = rng.random((saved_len, 3), dtype = np.float32)
+    now_co = save_co + rng.normal(scale = 0.01, size = save_co.shape).astype(np.float32)
+    record("get_distance", measure(lambda: usecase.get_distance(save_co, now_co, 0), args.repeat))
+    table = (np.linspace(0, 1, usecase.FALLOFF_TABLE_SIZE), np.linspace(0, 1, usecase.FALLOFF_TABLE_SIZE))
+    ranks = usecase.get_distance(save_co, now_co, 0)
+    record("evaluate_falloff", measure(lambda: usecase.evaluate_falloff(ranks, table), args.repeat))
+
+    # 元に戻す（編集モード、オブジェクトモード）
+    # invoke を通すと変更率が0に戻り、頂点数が多い場合はモーダルになるため EXEC_DEFAULT で execute だけを計測する
+    prop.restore_method = "SAVED"
+    prop.constant_rate = 50
+    for mode in ("EDIT", "OBJECT"):
+        for method in ("Constant", "Curve"):
+            prop.transform_method = method
+            set_mode(mode)
+            times = measure(lambda: bpy.ops.undo_verts.operator("EXEC_DEFAULT"), args.repeat, setup = lambda: move_verts(obj))
+            record("undo_operator", times, mode = mode, method = method)
+
+    # 保存した頂点の選択
+    # 保存直後の選択状態のままでは選択が変わらない処理だけを計測するため、毎回選択状態を戻してから計測する
+    # 追加・解除で保存した全ての頂点の選択状態が変わるよう、解除の場合は全て選択、それ以外は保存した頂点以外を選択しておく
+    set_mode("EDIT")
+    saved = np.zeros(verts_len, dtype = bool)
+    saved[UndoVertices.get_snapshot(bpy.context, obj).index] = True
+    for select in ("SELECT_SET", "SELECT_EXTEND", "SELECT_SUBTRACT", "SELECT_DIFFERENCE"):
+        prop.select = select
+        reset = np.ones(verts_len, dtype = bool) if select == "SELECT_SUBTRACT" else ~saved
+        times = measure(lambda: bpy.ops.select_verts.operator(), args.repeat, setup = lambda: mesh_helpers.set_verts_select_array(obj, reset))
+        record("select_save_verts", times, select = select)
+
+    set_mode("OBJECT")
+    remove_object(obj)
+
+def main():
+    args = parse_args()
+    addon.register()
+
+    results = []
+    try:
+        for size in args.sizes:
+            run_size(size, args, results)
+    finally:
+        addon.unregister()
+
+    report = {
+        "blender" : bpy.app.version_string,
+        "addon_version" : ".".join(str(v) for v in addon.bl_info["version"]),
+        "numpy" : np.__version__,
+        "repeat" : args.repeat,
+        "ratio" : args.ratio,
+        "results" : results,
+    }
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
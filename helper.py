@@ -15,16 +15,20 @@ import bpy
 import bmesh
 import math
 import numpy as np
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from .exception import *
 
 def is_mesh_edit(obj):
     return obj and obj.mode == "EDIT" and obj.type == "MESH"
 
 def area_3d_view_tag_redraw_all():
-    for area in bpy.context.screen.areas:
-        if area.type == "VIEW_3D":
-            area.tag_redraw()
+    # タイマーから呼ばれた場合は context.screen が無いため、全ウィンドウの画面を対象にする
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "VIEW_3D":
+                area.tag_redraw()
 
 # アクティブなエリアのSpaceView3Dを取得する
 def get_space_view_3d():
@@ -41,6 +45,19 @@ def is_in_normal_from_view_3d(context, normal):
     matrix_z = space_view_3d.region_3d.view_rotation.to_matrix().col[2]
     return normal.dot(matrix_z) < 0
 
+def run_in_thread_pool(func, items):
+    """要素ごとの処理をスレッドで並列に行う
+    NumPyの配列処理はGILを解放するため、オブジェクトごとの配列処理を並列にできる
+    bpyのデータはメインスレッド以外から触らないこと
+
+    :return list 要素と同じ並びの戻り値
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers = min(len(items), os.cpu_count() or 1)) as pool:
+        return list(pool.map(func, items))
+
 def show_message_info(message):
     def draw(self, context):
         self.layout.label(text = message)
@@ -73,6 +90,19 @@ def get_coord_calc_two_point(p1, p2, progress):
     """
     return tuple(p1[i] + (p2[i] - p1[i]) * progress for i in range(3))
 
+def get_coords_calc_two_point(p1, p2, progress):
+    """始点と終点からの進んだ割合を与えた場合の座標を配列でまとめて取得する
+
+    :param ndarray p1 始点 (N, 3)
+    :param ndarray p2 終点 (N, 3)
+    :param float|ndarray progress 0 ~ 1 (全頂点で共通の値、または頂点ごとの (N,))
+    :return ndarray (N, 3)
+    """
+    progress = np.asarray(progress, dtype = np.float32)
+    if progress.ndim == 1:
+        progress = progress[:, np.newaxis]
+    return p1 + (p2 - p1) * progress
+
 def get_avg_location(verts):
     """複数の頂点から平均座標を求める
     """
@@ -20,6 +20,8 @@
 
 import bmesh
 import bpy
+import numpy as np
+from itertools import chain
 # import bgl
 # import gpu
 # from gpu_extras.batch import batch_for_shader
@@ -248,6 +250,122 @@ def bmesh_from_object(obj):
     return bm
 
 
+def get_verts_len(obj):
+    """
+    Cheap vertex count for UI code.
+    In Edit Mode from_edit_mesh() only wraps the existing edit-mesh, no copy is made.
+    """
+    me = obj.data
+    if obj.mode == 'EDIT':
+        return len(from_edit_mesh(me).verts)
+    return len(me.vertices)
+
+
+def get_verts_array(me, attr, dtype=np.float32, size=3):
+    """
+    Read a vertex attribute of the whole mesh with a single foreach_get.
+    """
+    count = len(me.vertices)
+    arr = np.empty(count * size, dtype=dtype)
+    me.vertices.foreach_get(attr, arr)
+    return arr.reshape(count, size) if size > 1 else arr
+
+
+def get_edges_array(me):
+    """
+    Read the vertex index pairs of all edges with a single foreach_get.
+    """
+    edges = np.empty(len(me.edges) * 2, dtype=np.int32)
+    me.edges.foreach_get("vertices", edges)
+    return edges.reshape(-1, 2)
+
+
+def get_bm_verts_co_array(bm, index):
+    """
+    Read the coordinates of the given BMesh vertices only into an (N, 3) array.
+    """
+    bm.verts.ensure_lookup_table()
+    verts = bm.verts
+    co = np.fromiter(chain.from_iterable(verts[i].co for i in index.tolist()), dtype=np.float32, count=len(index) * 3)
+    return co.reshape(-1, 3)
+
+
+def get_bm_verts_hide_array(bm, index):
+    """
+    Read the hide flags of the given BMesh vertices only into a bool array.
+    """
+    bm.verts.ensure_lookup_table()
+    verts = bm.verts
+    return np.fromiter((verts[i].hide for i in index.tolist()), dtype=bool, count=len(index))
+
+
+def set_bm_verts_co_array(bm, index, co):
+    """
+    Write the coordinates of the given BMesh vertices only from an (N, 3) array.
+    """
+    bm.verts.ensure_lookup_table()
+    verts = bm.verts
+    for i, v_co in zip(index.tolist(), co.tolist()):
+        verts[i].co = v_co
+
+
+def update_edit_mesh_coords(me, bm):
+    """
+    Refresh the edit-mesh after only coordinates changed.
+    Normals are recalculated, but n-gon tessellation and topology caches are kept.
+    """
+    bm.normal_update()
+    bmesh.update_edit_mesh(me, loop_triangles=False, destructive=False)
+
+
+def get_verts_select_array(obj):
+    """
+    Read the vertex selection of the whole mesh as a bool array.
+    In Edit Mode the edit-mesh is written back to the mesh first.
+    """
+    if obj.mode == 'EDIT':
+        obj.update_from_editmode()
+    return get_verts_array(obj.data, "select", dtype=bool, size=1)
+
+
+def set_verts_select_array(obj, mask, current=None):
+    """
+    Write the vertex selection of the whole mesh from a bool array and flush it.
+    In Edit Mode only the vertices whose state changes are touched.
+    """
+    me = obj.data
+    if obj.mode == 'EDIT':
+        if current is None:
+            current = get_verts_select_array(obj)
+        bm = from_edit_mesh(me)
+        bm.verts.ensure_lookup_table()
+        verts = bm.verts
+        for i in np.flatnonzero(mask != current).tolist():
+            verts[i].select = bool(mask[i])
+        bm.select_flush_mode()
+        bmesh.update_edit_mesh(me)
+    else:
+        me.vertices.foreach_set("select", mask)
+
+        # Flush the selection to edges and faces.
+        me.edges.foreach_set("select", mask[get_edges_array(me)].all(axis=1))
+        if len(me.polygons):
+            loop_verts = np.empty(len(me.loops), dtype=np.int32)
+            me.loops.foreach_get("vertex_index", loop_verts)
+            loop_start = np.empty(len(me.polygons), dtype=np.int32)
+            me.polygons.foreach_get("loop_start", loop_start)
+            me.polygons.foreach_set("select", np.logical_and.reduceat(mask[loop_verts], loop_start))
+        me.update()
+
+
+def set_verts_co_array(me, co):
+    """
+    Write the coordinates of the whole mesh with a single foreach_set.
+    """
+    me.vertices.foreach_set("co", np.ascontiguousarray(co, dtype=np.float32).ravel())
+    me.update()
+
+
 
 
 # def bmesh_check_self_intersect_object(obj):
@@ -287,3 +405,52 @@ def bmesh_from_object(obj):
 #         if angle_fn(loopno, 1000.0) > angle_distort:
 #             return True
 #     return False
+
+
+def get_verts_int_attribute_array(me, name):
+    """
+    Read an integer point attribute of the whole mesh as an (M,) int32 array.
+    Like get_verts_array() this reads the mesh only; sync Edit Mode changes first.
+    Returns None if the mesh has no such attribute.
+    """
+    attribute = me.attributes.get(name)
+    if attribute is None:
+        return None
+    values = np.empty(len(me.vertices), dtype=np.int32)
+    attribute.data.foreach_get("value", values)
+    return values
+
+
+def get_bm_verts_int_layer_array(bm, name, index):
+    """
+    Read an integer layer of the given BMesh vertices only into an (N,) array.
+    Returns None if the BMesh has no such layer.
+    """
+    layer = bm.verts.layers.int.get(name)
+    if layer is None:
+        return None
+    bm.verts.ensure_lookup_table()
+    verts = bm.verts
+    return np.fromiter((verts[i][layer] for i in index.tolist()), dtype=np.int32, count=len(index))
+
+
+def set_verts_int_attribute_array(obj, name, index, values):
+    """
+    Write an integer point attribute for the given vertices only, creating it if needed.
+    In Edit Mode the values are written to the BMesh layer of the same name.
+    """
+    me = obj.data
+    if obj.mode == 'EDIT':
+        bm = from_edit_mesh(me)
+        layer = bm.verts.layers.int.get(name) or bm.verts.layers.int.new(name)
+        bm.verts.ensure_lookup_table()
+        verts = bm.verts
+        for i, value in zip(index.tolist(), values.tolist()):
+            verts[i][layer] = value
+    else:
+        attribute = me.attributes.get(name) or me.attributes.new(name, 'INT', 'POINT')
+        data = np.zeros(len(me.vertices), dtype=np.int32)
+        attribute.data.foreach_get("value", data)
+        data[index] = values
+        attribute.data.foreach_set("value", data)
+        me.update()
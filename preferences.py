@@ -90,8 +90,16 @@ class UndoVerticesPreferences(bpy.types.AddonPreferences):
         min=0,
         max=59)
 
+    # 保存データのメモリの上限 (MB)
+    snapshot_memory_budget = bpy.props.IntProperty(
+        name="Snapshot Memory Budget (MB)",
+        description="Least recently used snapshots are discarded above this size, 0 means unlimited",
+        default=1024,
+        min=0)
+
     def draw(self, context):
         layout = self.layout
+        layout.prop(self, "snapshot_memory_budget")
 
         # Works best if a column, or even just self.layout.
         mainrow = layout.row()
@@ -18,6 +18,10 @@ from .undo_vertices import UndoVertices
 # def update_is_view(self, context):
 #     UndoVertices.toggle_annotation_view()
 
+def update_is_modifier(self, context):
+    if self.is_modifier:
+        UndoVertices.request_geometry_mod()
+
 class UndoVerticesPropertyGroup(PropertyGroup, UndoVertices):
     transform_method_enums = [
         ("Constant", "Constant", "Constant", "NOCURVE", 1),
@@ -27,11 +31,20 @@ class UndoVerticesPropertyGroup(PropertyGroup, UndoVertices):
         ("DEFAULT", "Default", "Default", 1),
         ("3D_CURSOR", "Cursor", "Cursor", "ORIENTATION_CURSOR", 2),
     ]
+    restore_method_enums = [
+        ("SAVED", "Saved Vertices", "Restore the saved vertices to their saved positions", 1),
+        ("NEAREST", "Nearest Saved Position", "Pull the selected vertices toward the nearest saved position", 2),
+    ]
     lock_axiz_enums = [
         ("X", "X", ""),
         ("Y", "Y", ""),
         ("Z", "Z", ""),
     ]
+    combine_operation_enums = [
+        ("UNION", "Union", "Vertices saved in either slot", "SELECT_EXTEND", 1),
+        ("INTERSECT", "Intersect", "Vertices saved in both slots", "SELECT_INTERSECT", 2),
+        ("DIFFERENCE", "Difference", "Vertices saved in this slot but not in the other", "SELECT_SUBTRACT", 3),
+    ]
     select_enums = [
         ("SELECT_SET", "", "SELECT_SET", "SELECT_SET", 1),
         ("SELECT_EXTEND", "", "SELECT_EXTEND", "SELECT_EXTEND", 2),
@@ -41,6 +54,8 @@ class UndoVerticesPropertyGroup(PropertyGroup, UndoVertices):
 
     # 完全に元に戻すか
     is_undo : BoolProperty(name = "Completely Undo", default = False)
+    # 戻す頂点と座標
+    restore_method : EnumProperty(items = restore_method_enums, name = "Restore", default = "SAVED")
     # 変更方法
     transform_method : EnumProperty(items = transform_method_enums, name = "Method", default = "Constant")
     # 評価方法
@@ -53,6 +68,18 @@ class UndoVerticesPropertyGroup(PropertyGroup, UndoVertices):
     curve_rate : FloatProperty(name = "Curve Rate", default = 1, min = -100, max = 100, precision = 2)
     # 軸の固定
     lock_axiz : EnumProperty(items = lock_axiz_enums, name = "lock axiz", options = {"ENUM_FLAG"})
+    # 保存するスロット
+    save_slot : IntProperty(name = "Slot", default = 1, min = 1, max = 9)
+    # 頂点数が増減した場合に、保存した頂点を現在の頂点に対応させ直すか
+    is_remap : BoolProperty(name = "Remap", default = False)
+    # 対応させる頂点との距離の上限
+    remap_distance : FloatProperty(name = "Remap Distance", default = 0.001, min = 0, precision = 4, subtype = "DISTANCE")
+    # 組み合わせる保存データのスロット
+    combine_slot : IntProperty(name = "With Slot", default = 2, min = 1, max = 9)
+    # 組み合わせた結果を保存するスロット
+    combine_result_slot : IntProperty(name = "Result Slot", default = 3, min = 1, max = 9)
+    # 組み合わせ方
+    combine_operation : EnumProperty(items = combine_operation_enums, name = "Combine", default = "UNION")
     # 選択
     select : EnumProperty(items = select_enums, name = "Select", default = "SELECT_SET")
     # 非表示の頂点を変更するか
@@ -65,4 +92,4 @@ class UndoVerticesPropertyGroup(PropertyGroup, UndoVertices):
     # is_view_point : BoolProperty(name = "View Point", default = True, update = update_is_view)
 
     # モディファイアの評価を有効にするか
-    is_modifier : BoolProperty(name = "Modifier", default = False)
+    is_modifier : BoolProperty(name = "Modifier", default = False, update = update_is_modifier)
@@ -0,0 +1,468 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import weakref
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+
+from .mesh_helpers import get_verts_array, get_edges_array
+
+# 保存データのファイル形式
+# ヘッダ、保存データごとのレコードと配列の位置の表、配列の中身の順に並べる
+# 配列は読み込み時にメモリマップからそのまま参照できるよう、16byte境界に揃えて書き込む
+file_magic = b"UNDOVTX\0"
+file_version = 2
+# マジック, バージョン, 保存データの数
+file_header = struct.Struct("<8sII")
+# オブジェクトのキー, スロット, 保存時の全頂点数, 配列の数
+file_record = struct.Struct("<32sIII")
+# 配列の名前, 位置, 行数, 列数 (1次元の場合は0), 型
+file_buffer = struct.Struct("<24sQII4s")
+file_align = 16
+# 法線は表示の裏面判定にしか使わないため半精度で保存する
+file_half_names = ("normal", "edge_normals")
+
+class VerticesSnapshot():
+    """保存した頂点を連続した配列で保持する
+
+    index  : 頂点のインデックス (N,) int32
+    co     : 頂点の座標 (N, 3) float32
+    normal : 頂点の法線 (N, 3) float32
+    ids    : 頂点の識別子 (N,) int32  識別子を付与していない場合はNone
+
+    保存時の全頂点数と、表示用の形状も合わせて保持する
+    """
+
+    buffer_names = ("index", "co", "normal", "ids")
+
+    def __init__(self, index, co, normal, ids = None):
+        self.index = index
+        self.co = co
+        self.normal = normal
+        self.ids = ids
+        self.all_len = 0
+        self.geometry = None
+        self.geometry_mod = None
+        # モディファイア適用有の形状を未作成か
+        self.is_geometry_mod_pending = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_buffers(self):
+        """保持している配列を (持ち主, 属性名) で返す"""
+        for owner in (self, self.geometry, self.geometry_mod):
+            if owner is not None:
+                for name in owner.buffer_names:
+                    if getattr(owner, name) is not None:
+                        yield owner, name
+
+    def get_unique_buffers(self):
+        """保持している配列を重複なしで返す（ワールド行列が単位行列の場合、表示用の形状は保存データと同じ配列を参照する）
+
+        :return dict id : 配列
+        """
+        return {id(buffer) : buffer for buffer in (getattr(owner, name) for owner, name in self.get_buffers())}
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.get_unique_buffers().values())
+
+    @classmethod
+    def from_mask(cls, co, normal, mask):
+        """全頂点の配列から選択マスクに該当する頂点だけを取り出す
+
+        :param ndarray co 全頂点の座標 (M, 3)
+        :param ndarray normal 全頂点の法線 (M, 3)
+        :param ndarray mask 保存する頂点 (M,) bool
+        """
+        index = np.flatnonzero(mask).astype(np.int32)
+        return cls(index, co[index], normal[index])
+
+    @classmethod
+    def create(cls, mask, co, normal, edges, matrix_world, ids = None):
+        """全頂点の配列から保存データと表示用の形状を作る（bpyを使わないためスレッドから呼べる）
+
+        :param ndarray mask 保存する頂点 (M,) bool
+        :param ndarray co 全頂点の座標 (M, 3)
+        :param ndarray normal 全頂点の法線 (M, 3)
+        :param ndarray edges 全ての辺の頂点の組 (E, 2)
+        :param Matrix matrix_world オブジェクトのワールド行列
+        :param ndarray ids 全頂点の識別子 (M,)
+        """
+        snapshot = cls.from_mask(co, normal, mask)
+        if ids is not None:
+            snapshot.ids = ids[snapshot.index]
+        snapshot.all_len = len(mask)
+        snapshot.geometry = SnapshotGeometry.create(snapshot.co, snapshot.normal, edges, mask, matrix_world)
+        # モディファイア適用有の状態は表示で必要になったときに作成する
+        snapshot.is_geometry_mod_pending = True
+        return snapshot
+
+    @classmethod
+    def combine(cls, a, b, operation, edges, matrix_world, all_len):
+        """2つの保存データの頂点の集合を組み合わせた保存データを作る (O(n) BMeshの頂点は使わない)
+        両方の保存データは現在の頂点のインデックスに対応させておくこと
+
+        :param VerticesSnapshot a 保存データ（無い場合はNone）
+        :param VerticesSnapshot b 保存データ（無い場合はNone）
+        :param str operation "UNION" : 和集合, "INTERSECT" : 積集合, "DIFFERENCE" : a から b を除いた差集合
+        :param ndarray edges 現在の全ての辺の頂点の組 (E, 2)  表示用の形状に使う
+        :param Matrix matrix_world オブジェクトのワールド行列
+        :param int all_len 現在の全頂点数
+        """
+        # 保存データごとに、頂点のインデックスから保存した並び順 (スロット) を引く表を作る
+        slots = []
+        for snapshot in (a, b):
+            lookup = np.full(all_len, -1, dtype = np.int32)
+            if snapshot is not None:
+                lookup[snapshot.index] = np.arange(len(snapshot), dtype = np.int32)
+            slots.append(lookup)
+        in_a = slots[0] >= 0
+        in_b = slots[1] >= 0
+
+        if operation == "UNION":
+            mask = in_a | in_b
+        elif operation == "INTERSECT":
+            mask = in_a & in_b
+        elif operation == "DIFFERENCE":
+            mask = in_a & ~in_b
+        else:
+            raise ValueError("unknown operation : " + operation)
+
+        # 両方に含まれる頂点は a の値を使う
+        index = np.flatnonzero(mask).astype(np.int32)
+        from_a = in_a[index]
+        from_b = ~from_a
+
+        def gather(name, dtype):
+            if (from_a.any() and getattr(a, name) is None) or (from_b.any() and getattr(b, name) is None):
+                return None
+            source = getattr(a if from_a.any() or b is None else b, name)
+            if source is None:
+                return None
+            shape = source.shape[1:]
+            values = np.empty((len(index),) + shape, dtype = dtype)
+            if from_a.any():
+                values[from_a] = getattr(a, name)[slots[0][index[from_a]]]
+            if from_b.any():
+                values[from_b] = getattr(b, name)[slots[1][index[from_b]]]
+            return values
+
+        snapshot = cls(index, gather("co", np.float32), gather("normal", np.float32), gather("ids", np.int32))
+        snapshot.all_len = all_len
+        # 表示用の形状は、組み合わせた頂点の保存した座標と現在の辺から作り直す
+        snapshot.geometry = SnapshotGeometry.create(snapshot.co, snapshot.normal, edges, mask, matrix_world)
+        # モディファイア適用有の状態は表示で必要になったときに作成する
+        snapshot.is_geometry_mod_pending = True
+        return snapshot
+
+    def get_file_buffers(self):
+        """ファイルに保存する配列を (名前, 配列) で返す（モディファイア適用有の形状は読み込み後に作り直せるため保存しない）"""
+        for owner, name in self.get_buffers():
+            if owner is self:
+                yield name, getattr(owner, name)
+            elif owner is self.geometry:
+                yield "geometry." + name, getattr(owner, name)
+
+    @classmethod
+    def from_file_buffers(cls, buffers, all_len):
+        """ファイルから読み込んだ配列から保存データを作る
+
+        :param dict buffers 名前 : 配列
+        """
+        snapshot = cls(buffers["index"], buffers["co"], buffers["normal"], buffers.get("ids"))
+        snapshot.all_len = all_len
+        if "geometry.co" in buffers:
+            names = SnapshotGeometry.buffer_names
+            snapshot.geometry = SnapshotGeometry.from_buffers(*[buffers["geometry." + name] for name in names])
+        snapshot.is_geometry_mod_pending = True
+        return snapshot
+
+    @classmethod
+    def from_mesh(cls, me, mask = None):
+        """メッシュの頂点をまとめて読み込み、選択している頂点を保存する
+        編集モードの場合は事前に obj.update_from_editmode() でメッシュへ書き戻しておくこと
+        """
+        if mask is None:
+            mask = get_verts_array(me, "select", dtype = bool, size = 1)
+        co = get_verts_array(me, "co")
+        normal = get_verts_array(me, "normal")
+        return cls.from_mask(co, normal, mask)
+
+class SnapshotGeometry():
+    """保存した頂点とその間の辺だけをワールド座標の配列で保持する (表示用)
+
+    co           : 頂点の座標 (N, 3) float32
+    normal       : 頂点の法線 (N, 3) float32
+    edges        : 辺の頂点の組 (E, 2) int32  co の並びを参照する
+    edge_normals : 辺の両端の法線の和 (E, 3) float32  表示時の裏面判定に使う
+    """
+
+    buffer_names = ("co", "normal", "edges", "edge_normals")
+
+    def __init__(self, co, normal, edges):
+        self.co = co
+        self.normal = normal
+        self.edges = edges
+        self.edge_normals = normal[edges[:, 0]] + normal[edges[:, 1]]
+
+    def __len__(self):
+        return len(self.co)
+
+    @property
+    def nbytes(self):
+        return self.co.nbytes + self.normal.nbytes + self.edges.nbytes + self.edge_normals.nbytes
+
+    @classmethod
+    def from_buffers(cls, co, normal, edges, edge_normals):
+        """辺の法線を計算済みの配列から作る"""
+        geometry = cls.__new__(cls)
+        geometry.co = co
+        geometry.normal = normal
+        geometry.edges = edges
+        geometry.edge_normals = edge_normals
+        return geometry
+
+    @classmethod
+    def create(cls, co, normal, edges, mask, matrix_world):
+        """選択している頂点だけを取り出した配列から表示用の形状を作る
+
+        :param ndarray co 選択している頂点の座標 (N, 3)
+        :param ndarray normal 選択している頂点の法線 (N, 3)
+        :param ndarray edges 全ての辺の頂点の組 (E, 2)
+        :param ndarray mask 選択している頂点 (M,) bool
+        :param Matrix matrix_world オブジェクトのワールド行列
+        """
+        # 両端が選択されている辺だけを残し、選択した頂点の並びに詰め直す
+        remap = np.full(len(mask), -1, dtype = np.int32)
+        remap[mask] = np.arange(np.count_nonzero(mask), dtype = np.int32)
+        edges = remap[edges[mask[edges].all(axis = 1)]]
+
+        # ワールド行列を一度の行列積で適用する
+        matrix = np.array(matrix_world, dtype = np.float32)
+        rotation = matrix[:3, :3]
+        co = co @ rotation.T + matrix[:3, 3]
+        normal = normal @ np.linalg.pinv(rotation)
+        return cls(co.astype(np.float32), normal.astype(np.float32), edges)
+
+    @classmethod
+    def from_mesh(cls, me, matrix_world, mask = None):
+        """メッシュから選択している頂点と辺だけを取り出す"""
+        if mask is None:
+            mask = get_verts_array(me, "select", dtype = bool, size = 1)
+        co = get_verts_array(me, "co")[mask]
+        normal = get_verts_array(me, "normal")[mask]
+        return cls.create(co, normal, get_edges_array(me), mask, matrix_world)
+
+    @classmethod
+    def from_evaluated(cls, obj, depsgraph):
+        """モディファイア適用後のメッシュから選択している頂点と辺だけを取り出す"""
+        if not obj.modifiers:
+            return cls.from_mesh(obj.data, obj.matrix_world)
+
+        obj_eval = obj.evaluated_get(depsgraph)
+        me = obj_eval.to_mesh()
+        try:
+            return cls.from_mesh(me, obj.matrix_world)
+        finally:
+            obj_eval.to_mesh_clear()
+
+class SnapshotStore():
+    """複数の保存データをキーごとに保持する
+
+    メモリの上限を超えた場合は、最も長く使われていない保存データから破棄する
+    保存データ間で内容が同じ配列は同じ配列を参照し、メモリを重複して使わない
+    """
+
+    def __init__(self, budget = 0):
+        # キー : 保存データ（並び順は使われた順）
+        self.slots = OrderedDict()
+        # メモリの上限 (byte) 0 の場合は上限無し
+        self.budget = budget
+        # (形, 型, CRC32) : 配列  保存時に同じ内容の配列を全ての保存データと比較せずに探すための索引
+        # 保存データが破棄された配列は自動で索引から消える
+        self.buffer_index = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def get(self, key):
+        snapshot = self.slots.get(key)
+        if snapshot is not None:
+            self.slots.move_to_end(key)
+        return snapshot
+
+    def set(self, key, snapshot):
+        self.slots.pop(key, None)
+        self.share_buffers(snapshot)
+        self.slots[key] = snapshot
+        self.evict()
+
+    def remove(self, key):
+        self.slots.pop(key, None)
+
+    def clear(self):
+        self.slots.clear()
+        self.buffer_index.clear()
+
+    def keys(self):
+        return list(self.slots.keys())
+
+    def share_buffers(self, snapshot):
+        """他の保存データと内容が同じ配列を、既存の配列の参照に置き換える
+        配列ごとのCRC32で索引を引き、一致した配列とだけ内容を比較するため、保存データの数が増えても遅くならない
+        共有するのは配列全体が同じ場合のみ（一部の頂点だけが異なる配列は共有しない）
+        """
+        for owner, name in snapshot.get_buffers():
+            buffer = getattr(owner, name)
+            key = (buffer.shape, buffer.dtype.str, zlib.crc32(np.ascontiguousarray(buffer).data))
+            other = self.buffer_index.get(key)
+            if other is not None and other is not buffer and np.array_equal(other, buffer):
+                setattr(owner, name, other)
+            else:
+                self.buffer_index[key] = buffer
+
+    @property
+    def nbytes(self):
+        """共有している配列は一度だけ数えた合計のメモリ (byte)"""
+        buffers = {}
+        for snapshot in self.slots.values():
+            buffers.update(snapshot.get_unique_buffers())
+        return sum(buffer.nbytes for buffer in buffers.values())
+
+    def evict(self):
+        """メモリの上限を超えている場合は最も長く使われていない保存データから破棄する（最新の1つは残す）"""
+        while self.budget > 0 and len(self.slots) > 1 and self.nbytes > self.budget:
+            self.slots.popitem(last = False)
+
+    def list(self):
+        """保存データの一覧を返す
+
+        :return list [(キー, 頂点数, 使用メモリ, 他の保存データと共有しているメモリ), ...] 使われた順
+        """
+        # 同じ保存データの中で参照している配列は1つと数え、他の保存データからも参照されている場合のみ共有とみなす
+        buffers = [(key, snapshot, snapshot.get_unique_buffers()) for key, snapshot in self.slots.items()]
+        counts = {}
+        for _, _, unique in buffers:
+            for buffer_id in unique:
+                counts[buffer_id] = counts.get(buffer_id, 0) + 1
+
+        result = []
+        for key, snapshot, unique in buffers:
+            nbytes = sum(buffer.nbytes for buffer in unique.values())
+            shared = sum(buffer.nbytes for buffer_id, buffer in unique.items() if counts[buffer_id] > 1)
+            result.append((key, len(snapshot), nbytes, shared))
+        return result
+
+    def save(self, path, keys = None):
+        """保存データをファイルに書き込む
+        保存データ間で共有している配列は一度だけ書き込み、読み込み時も共有する
+
+        :param str path 書き込むファイル
+        :param list keys 書き込む保存データのキー（省略時は全て）
+        """
+        items = [(key, self.slots[key]) for key in (self.slots if keys is None else keys)]
+
+        # 配列の位置の表を先に作り、中身はその後ろに並べる
+        table = [file_header.pack(file_magic, file_version, len(items))]
+        offset = file_header.size + sum(file_record.size + file_buffer.size * len(list(snapshot.get_file_buffers())) for _, snapshot in items)
+        written = {}
+        buffers = []
+        for (object_key, slot), snapshot in items:
+            file_buffers = list(snapshot.get_file_buffers())
+            table.append(file_record.pack(object_key.encode("ascii"), slot, snapshot.all_len, len(file_buffers)))
+            for name, buffer in file_buffers:
+                if id(buffer) not in written:
+                    dtype = np.float16 if name.split(".")[-1] in file_half_names else buffer.dtype.newbyteorder("<")
+                    data = np.ascontiguousarray(buffer, dtype = dtype)
+                    offset = -(-offset // file_align) * file_align
+                    written[id(buffer)] = (offset, data)
+                    buffers.append((offset, data))
+                    offset += data.nbytes
+                buffer_offset, data = written[id(buffer)]
+                rows, cols = data.shape if data.ndim == 2 else (data.shape[0], 0)
+                table.append(file_buffer.pack(name.encode("ascii"), buffer_offset, rows, cols, data.dtype.str.encode("ascii")))
+
+        # 書き込み中に失敗しても以前のファイルを壊さないよう、一時ファイルに書いてから置き換える
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(b"".join(table))
+                for buffer_offset, data in buffers:
+                    f.seek(buffer_offset)
+                    f.write(data.tobytes())
+            try:
+                os.replace(temp_path, path)
+            except PermissionError:
+                # Windowsではメモリマップで開いているファイルを置き換えられないため、配列をメモリへ読み込んでから置き換える
+                self.detach_buffers()
+                os.replace(temp_path, path)
+        except Exception:
+            # 失敗した場合は一時ファイルを残さない
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def load(self, path):
+        """ファイルから保存データを読み込む
+        配列はメモリマップからコピーせずに参照するため、頂点数が多くてもすぐに読み込める
+
+        :return int 読み込んだ保存データの数
+        """
+        if os.path.getsize(path) < file_header.size:
+            raise ValueError("invalid snapshot file : " + path)
+        data = np.memmap(path, dtype = np.uint8, mode = "r")
+        magic, version, count = file_header.unpack_from(data, 0)
+        if magic != file_magic or version != file_version:
+            raise ValueError("invalid snapshot file : " + path)
+
+        position = file_header.size
+        views = {}
+        for _ in range(count):
+            object_key, slot, all_len, buffer_count = file_record.unpack_from(data, position)
+            position += file_record.size
+            buffers = {}
+            for _ in range(buffer_count):
+                name, offset, rows, cols, dtype = file_buffer.unpack_from(data, position)
+                position += file_buffer.size
+                # 空の配列は次の配列と位置が重なるため、位置と形で区別する
+                view_key = (offset, rows, cols, dtype)
+                if view_key not in views:
+                    dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+                    shape = (rows, cols) if cols > 0 else (rows,)
+                    views[view_key] = data[offset:offset + rows * max(cols, 1) * dtype.itemsize].view(dtype).reshape(shape)
+                buffers[name.rstrip(b"\0").decode("ascii")] = views[view_key]
+            key = (object_key.rstrip(b"\0").decode("ascii"), slot)
+            self.slots[key] = VerticesSnapshot.from_file_buffers(buffers, all_len)
+        return count
+
+    def detach_buffers(self):
+        """メモリマップで参照している配列をメモリへ読み込み、ファイルを閉じられるようにする
+        保存データ以外の場所（描画用のキャッシュなど）でメモリマップを参照していると閉じられないため、そちらはコピーして持つこと
+        """
+        copies = {}
+        for snapshot in self.slots.values():
+            for owner, name in snapshot.get_buffers():
+                buffer = getattr(owner, name)
+                if isinstance(buffer, np.memmap):
+                    if id(buffer) not in copies:
+                        copies[id(buffer)] = np.array(buffer)
+                    setattr(owner, name, copies[id(buffer)])
@@ -12,7 +12,9 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import bmesh
-import time
+import numpy as np
+import weakref
+import zlib
 from bpy.types import Operator
 from .undo_vertices import UndoVertices
 from .helper import *
@@ -24,12 +26,49 @@ class UndoVerticesUndoOperator(Operator, UndoVertices):
     bl_label = "Undo Vertices Control"
     bl_options = {"REGISTER", "UNDO"}
 
-    # 保存する頂点
-    save_selected_verts = None
+    # モーダルで一度に処理する頂点数
+    chunk_size = 50000
 
-    # 作業用の一時モディファイアの名前
+    # 移動量の順位のキャッシュ
+    # カーブの変更率やカーブの形だけを変えた再実行では頂点の位置は変わらないため、順位を再計算しない
+    # 保存データ : (キー, 順位)
+    ranks_cache = weakref.WeakKeyDictionary()
+
+    # 保存した座標のKDツリーのキャッシュ（保存データごとに一度だけ作り、再実行では使い回す）
+    # 保存データ : KDツリー
+    kdtree_cache = weakref.WeakKeyDictionary()
+
+    # 以前のバージョンでカーブの保持に使っていた作業用の一時モディファイアの名前
     modifier_name = "__UndoVerticesWorkingTemporaryModifier__"
 
+    # カーブを保持する作業用のノードグループの名前
+    # モディファイアと異なりメッシュの評価に影響しないため、カーブを編集してもモディファイアスタックは再評価されない
+    # 名前を "." で始めてノードグループの一覧に表示されないようにする
+    # フェイクユーザーを付けないため、利用者の.blendには保存されない（カーブの形は作業中のみ保持する）
+    curve_node_group_name = ".UndoVerticesFalloffCurve"
+    curve_node_name = "Falloff"
+
+    @classmethod
+    def get_falloff_curve_node(self, is_create = False):
+        """カーブを保持するノードを取得する（drawではデータを作成できないため、作成はexecuteでのみ行う）"""
+        group = bpy.data.node_groups.get(self.curve_node_group_name)
+        if group is None:
+            if is_create == False:
+                return None
+            group = bpy.data.node_groups.new(self.curve_node_group_name, "ShaderNodeTree")
+        elif is_create and group.use_fake_user:
+            # 以前のバージョンでフェイクユーザーを付けて保存したファイルから取り除く
+            group.use_fake_user = False
+
+        node = group.nodes.get(self.curve_node_name)
+        if node is None:
+            if is_create == False:
+                return None
+            node = group.nodes.new("ShaderNodeFloatCurve")
+            node.name = self.curve_node_name
+            node.mapping.use_clip = True
+        return node
+
     @classmethod
     def remove_working_temporary_modifier(self):
         obj = bpy.context.active_object
@@ -44,6 +83,10 @@ class UndoVerticesUndoOperator(Operator, UndoVertices):
 
         # ---------------------------------------
         box = layout.box()
+        row = box.row()
+        row.scale_y = 1.5
+        row.prop(prop, "restore_method")
+
         row = box.row()
         row.scale_y = 2
         row.prop(prop, "is_undo")
@@ -78,8 +121,7 @@ class UndoVerticesUndoOperator(Operator, UndoVertices):
             row.prop(prop, "constant_rate", icon = "NOCURVE")
 
         elif prop.transform_method == "Curve":
-            obj = context.active_object
-            mod = obj.modifiers[self.modifier_name]
+            node = self.get_falloff_curve_node()
             box = layout.box()
             box.enabled = prop.is_undo != True
             row = box.row()
@@ -91,107 +133,141 @@ class UndoVerticesUndoOperator(Operator, UndoVertices):
             row = box.row()
             row.scale_y = 2
             row.prop(prop, "eval_roughness")
-            box.template_curve_mapping(mod, "falloff_curve")
+            if node is not None:
+                box.template_curve_mapping(node, "mapping")
 
-    def execute(self, context):
+    @classmethod
+    def get_kdtree(self, snapshot):
+        """保存した座標のKDツリーを取得する"""
+        kd = self.kdtree_cache.get(snapshot)
+        if kd is None:
+            kd = create_kdtree(snapshot.co)
+            self.kdtree_cache[snapshot] = kd
+        return kd
+
+    @classmethod
+    def get_ranks(self, snapshot, save_co, now_co, eval_method, roughness, fixed = None):
+        """頂点ごとの移動量の順位を求める（保存データ・戻す座標・現在の座標・評価方法が同じ場合はキャッシュを返す）
+        bpyを使わないためスレッドから呼べる
+        """
+        key = (
+            None if save_co is snapshot.co else zlib.crc32(np.ascontiguousarray(save_co).data),
+            zlib.crc32(np.ascontiguousarray(now_co).data),
+            eval_method,
+            roughness,
+            None if fixed is None else tuple(fixed),
+        )
+        cache = self.ranks_cache.get(snapshot)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        if fixed is not None:
+            ranks = get_distance(save_co, now_co, roughness / 1000, fixed)
+        else :
+            # 変更前と変更後の距離を取得する
+            ranks = get_distance(save_co, now_co, roughness / 1000)
+
+        self.ranks_cache[snapshot] = (key, ranks)
+        return ranks
+
+    def get_rate_params(self, context):
+        """変更率の計算に必要な値をメインスレッドで取得する"""
         prop = context.scene.undo_vertices_prop
-        obj = bpy.context.active_object
-        me = obj.data
-        bm = bmesh_from_object(obj)
-        bm.verts.ensure_lookup_table()
+        params = {
+            "transform_method" : prop.transform_method,
+            "constant_rate" : prop.constant_rate / 100,
+        }
+
+        # カーブによる編集時のみ
+        if prop.transform_method == "Curve":
+            # drawで実行したマップを一定の数で評価した表を作る
+            node = self.get_falloff_curve_node(is_create = True)
+            params["table"] = get_curve_map_table(node.mapping, prop.curve_rate)
+            params["eval_method"] = prop.eval_method
+            params["roughness"] = prop.eval_roughness
+            params["fixed"] = context.scene.cursor.location.copy() if prop.eval_method == "3D_CURSOR" else None
+
+        return params
 
-        # 頂点数が減っている場合はキャンセルする
-        if UndoVertices.is_len_diff() == False:
-            show_message_error("頂点数が増減した場合、元に戻すことはできません。")
-            return {"CANCELLED"}
+    @classmethod
+    def get_save_co(self, job):
+        """頂点ごとに戻す座標を求める（bpyを使わないためスレッドから呼べる）
 
-        # 頂点数が多すぎる場合は負荷が高いため、タイムアウトによるエラーを検知できるようにする
-        start_time = time.time()
-        try:
-            # カーブによる編集時のみ
-            if prop.transform_method == "Curve":
-                # 制御用のワープモディファイアを編集時のみ追加
-                if obj.modifiers.find(self.modifier_name) < 0:
-                    bpy.ops.object.modifier_add(type = "WARP")
-                    mod = obj.modifiers[-1]
-                    mod.name = self.modifier_name
-                    mod.falloff_type = "CURVE"
-                    mod.falloff_curve.use_clip = True
-
-                # drawで実行したマップからカーブの座標を取得する
-                locations = get_curve_map_locations(obj.modifiers[self.modifier_name], prop.curve_rate)
-
-                if prop.eval_method == "3D_CURSOR" :
-                    distance = get_distance(UndoVertices.save_selected_verts, bm, prop.eval_roughness / 1000, bpy.context.scene.cursor.location)
-                else :
-                    # 変更前と変更後の距離を取得する
-                    distance = get_distance(UndoVertices.save_selected_verts, bm, prop.eval_roughness / 1000)
-
-                # UI_カーブマッピングをベジェに変換する
-                bezier_y = create_bezier_curve(UndoVertices.get_len_save_verts(), locations[0], locations[1])
-                total = len(bezier_y)
-                for v in UndoVertices.save_selected_verts:
-
-                    save_co = v[0]
-                    index = v[2]
-                    now_co = bm.verts[index].co
-                    is_hide = False
-                    if prop.change_hide_vertices == False:
-                        is_hide = bm.verts[index].hide
-
-                    if is_hide :
-                        bm.verts[index].co.x = save_co[0]
-                        bm.verts[index].co.y = save_co[1]
-                        bm.verts[index].co.z = save_co[2]
-                    else :
-                        for d in distance:
-                            if index == d[1]:
-                                pos = d[0]
-                                break
-
-                        pos = int(total * pos) - 1
-                        calc_rate = bezier_y[pos]
-
-                        calc_co = get_coord_calc_two_point(save_co, now_co, calc_rate)
-                        bm.verts[index].co.x = save_co[0] if "X" in prop.lock_axiz or prop.is_undo else calc_co[0]
-                        bm.verts[index].co.y = save_co[1] if "Y" in prop.lock_axiz or prop.is_undo else calc_co[1]
-                        bm.verts[index].co.z = save_co[2] if "Z" in prop.lock_axiz or prop.is_undo else calc_co[2]
-
-                    show_message_error_for_timeout(start_time, 3, "処理が長すぎるためキャンセルしました。Saveする頂点を減らしてみてください。")
-
-            elif prop.transform_method == "Constant":
-                for v in UndoVertices.save_selected_verts:
-                    save_co = v[0]
-                    index = v[2]
-                    now_co = bm.verts[index].co
-
-                    is_hide = False
-                    if prop.change_hide_vertices == False:
-                        is_hide = bm.verts[index].hide
-
-                    if is_hide :
-                        bm.verts[index].co.x = save_co[0]
-                        bm.verts[index].co.y = save_co[1]
-                        bm.verts[index].co.z = save_co[2]
-                    else :
-                        calc_co = get_coord_calc_two_point(save_co, now_co, prop.constant_rate / 100)
-                        bm.verts[index].co.x = save_co[0] if "X" in prop.lock_axiz or prop.is_undo  else calc_co[0]
-                        bm.verts[index].co.y = save_co[1] if "Y" in prop.lock_axiz or prop.is_undo  else calc_co[1]
-                        bm.verts[index].co.z = save_co[2] if "Z" in prop.lock_axiz or prop.is_undo  else calc_co[2]
-
-                    show_message_error_for_timeout(start_time, 3, "処理が長すぎるためキャンセルしました。Saveする頂点を減らしてみてください。")
-
-        # タイムアウト例外
-        except TimeoutErrorException as e:
-            print(e)
-            # 強制的に変更率が0の状態に戻す
-            prop.transform_method = "Constant"
-            prop.constant_rate = 0
+        保存した頂点を戻す場合は保存した座標、最も近い保存位置に戻す場合は現在の座標から最も近い保存した座標
+        """
+        if job.is_nearest:
+            nearest = find_nearest_index(self.get_kdtree(job.snapshot), job.now_co)
+            return job.snapshot.co[nearest]
+        return job.snapshot.co
+
+    @classmethod
+    def get_undo_rate(self, snapshot, save_co, now_co, params):
+        """頂点ごとの変更率を求める
+
+        :param ndarray save_co 戻す座標 (N, 3)
+        :param ndarray now_co 現在の座標 (N, 3)  カーブ以外では使わないためNoneでも良い
+        :return float|ndarray 全頂点で共通の変更率、または頂点ごとの変更率 (N,)
+        """
+        if params["transform_method"] == "Curve":
+            # 順位の位置でカーブの変更率を評価する
+            ranks = self.get_ranks(snapshot, save_co, now_co, params["eval_method"], params["roughness"], params["fixed"])
+            return evaluate_falloff(ranks, params["table"])
+
+        return params["constant_rate"]
+
+    def get_jobs(self, context):
+        """保存データがあり、現在の頂点に対応させられるオブジェクトごとの処理を作る"""
+        is_nearest = context.scene.undo_vertices_prop.restore_method == "NEAREST"
+        jobs = []
+        for obj in UndoVertices.get_target_objects(context):
+            snapshot = UndoVertices.get_snapshot(context, obj)
+            if snapshot is None:
+                continue
+            # 最も近い保存位置に戻す場合は、保存した頂点ではなく現在選択している頂点を対象にする
+            if is_nearest:
+                index = np.flatnonzero(get_verts_select_array(obj)).astype(np.int32)
+                if len(index) > 0:
+                    jobs.append(UndoVerticesJob(obj, snapshot, index, is_nearest = True))
+                continue
+            # 保存データを現在の頂点に対応させられないものは対象外にする
+            snapshot = UndoVertices.resolve_snapshot(context, obj, self.report)
+            if snapshot is None:
+                self.report({"WARNING"}, "保存した頂点に対応する頂点が無いため元に戻せません : " + obj.name)
+                continue
+            jobs.append(UndoVerticesJob(obj, snapshot, snapshot.index))
+        return jobs
+
+    def execute(self, context):
+        prop = context.scene.undo_vertices_prop
+        jobs = self.get_jobs(context)
+
+        if 1 > len(jobs):
+            if prop.restore_method == "NEAREST":
+                show_message_error("頂点が選択されていません。")
+            else:
+                show_message_error("頂点数が増減した場合、元に戻すことはできません。")
             return {"CANCELLED"}
 
-        bmesh.update_edit_mesh(me)
-        bpy.ops.object.editmode_toggle()
-        bpy.ops.object.mode_set(mode = "EDIT")
+        # bpyのデータの読み込みはメインスレッドで行う
+        params = self.get_rate_params(context)
+        lock_axiz = set(prop.lock_axiz)
+        is_undo = prop.is_undo
+        hide_vertices = prop.change_hide_vertices == False
+        for job in jobs:
+            job.read(hide_vertices)
+
+        # 配列の処理はオブジェクトごとにスレッドで並列に行う
+        # スレッドではbpyのデータ（オペレーターとプロパティを含む）に触れず、読み込み済みの値だけを使う
+        operator = UndoVerticesUndoOperator
+        def calc(job):
+            job.save_co = operator.get_save_co(job)
+            rate = operator.get_undo_rate(job.snapshot, job.save_co, job.now_co, params)
+            job.calc_co = calc_undo_coords(job.save_co, job.now_co, rate, lock_axiz, is_undo, job.hide)
+        run_in_thread_pool(calc, jobs)
+
+        # 全てのオブジェクトを1回の操作で書き戻すため、Undoの履歴は1つになる
+        for job in jobs:
+            job.write()
 
         return{"FINISHED"}
 
@@ -199,9 +275,147 @@ class UndoVerticesUndoOperator(Operator, UndoVertices):
         prop = context.scene.undo_vertices_prop
         if event:
             prop.constant_rate = 0
-       
+
+        # 保存した頂点数が多い場合はUIを止めないように分割して処理する
+        if context.mode == "EDIT_MESH":
+            jobs = self.get_jobs(context)
+            if sum(len(job.index) for job in jobs) > self.chunk_size:
+                return self.modal_start(context, jobs)
+
         return self.execute(context)
 
+    def modal_start(self, context, jobs):
+        prop = context.scene.undo_vertices_prop
+        params = self.get_rate_params(context)
+
+        # オブジェクトごとに変更率を求め、一定の頂点数で分割する
+        self._chunks = []
+        for job in jobs:
+            job.bm = bmesh.from_edit_mesh(job.obj.data)
+            job.bm.verts.ensure_lookup_table()
+            if job.is_nearest or prop.transform_method == "Curve":
+                job.now_co = get_bm_verts_co_array(job.bm, job.index)
+            job.save_co = self.get_save_co(job)
+            job.rate = self.get_undo_rate(job.snapshot, job.save_co, job.now_co, params)
+            # キャンセル時に戻すため、書き込む前の座標を保持する
+            total = len(job.index)
+            job.backup_co = np.empty((total, 3), dtype = np.float32)
+            job.done = 0
+            for start in range(0, total, self.chunk_size):
+                self._chunks.append((job, slice(start, min(start + self.chunk_size, total))))
+
+        self._jobs = jobs
+        self._done = 0
+
+        wm = context.window_manager
+        wm.progress_begin(0, len(self._chunks))
+        self._timer = wm.event_timer_add(0.001, window = context.window)
+        wm.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context, event):
+        if event.type == "ESC":
+            self.modal_cancel(context)
+            return {"CANCELLED"}
+
+        if event.type != "TIMER":
+            return {"RUNNING_MODAL"}
+
+        prop = context.scene.undo_vertices_prop
+        job, chunk = self._chunks[self._done]
+        index = job.index[chunk]
+
+        now_co = get_bm_verts_co_array(job.bm, index)
+        job.backup_co[chunk] = now_co
+        hide = None
+        if prop.change_hide_vertices == False:
+            hide = get_bm_verts_hide_array(job.bm, index)
+        rate = job.rate[chunk] if isinstance(job.rate, np.ndarray) else job.rate
+
+        calc_co = calc_undo_coords(job.save_co[chunk], now_co, rate, prop.lock_axiz, prop.is_undo, hide)
+        set_bm_verts_co_array(job.bm, index, calc_co)
+        job.done = chunk.stop
+        self._done += 1
+
+        total = len(self._chunks)
+        context.window_manager.progress_update(self._done)
+        context.workspace.status_text_set("Undo Vertices : %d / %d (Esc : Cancel)" % (self._done, total))
+
+        if self._done < total:
+            return {"RUNNING_MODAL"}
+
+        for job in self._jobs:
+            update_edit_mesh_coords(job.obj.data, job.bm)
+        self.modal_finish(context)
+        return {"FINISHED"}
+
+    def modal_cancel(self, context):
+        # 書き込み済みの頂点を処理前の座標に戻す
+        for job in self._jobs:
+            chunk = slice(0, job.done)
+            set_bm_verts_co_array(job.bm, job.index[chunk], job.backup_co[chunk])
+            update_edit_mesh_coords(job.obj.data, job.bm)
+        self.modal_finish(context)
+
+    def modal_finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        self._jobs = None
+        self._chunks = None
+
+class UndoVerticesJob():
+    """1つのオブジェクトに対するUndoの処理内容
+
+    index      : 変更する頂点のインデックス (N,)
+    is_nearest : 保存した頂点ではなく、最も近い保存位置に戻すか
+    """
+
+    def __init__(self, obj, snapshot, index, is_nearest = False):
+        self.obj = obj
+        self.snapshot = snapshot
+        self.index = index
+        self.is_nearest = is_nearest
+        self.bm = None
+        self.all_co = None
+        self.now_co = None
+        self.hide = None
+        self.save_co = None
+        self.calc_co = None
+
+    def read(self, hide_vertices):
+        """変更する頂点の現在の座標を読み込む
+
+        :param bool hide_vertices 非表示の頂点を保存した座標に戻すか
+        """
+        me = self.obj.data
+        index = self.index
+
+        # 編集モードでは変更する頂点だけをBMeshから直接読み込み、モードの切り替えを行わない
+        if self.obj.mode == "EDIT":
+            self.bm = bmesh.from_edit_mesh(me)
+            self.now_co = get_bm_verts_co_array(self.bm, index)
+            if hide_vertices:
+                self.hide = get_bm_verts_hide_array(self.bm, index)
+
+        # オブジェクトモードでは全頂点の座標をまとめて読み込む
+        else:
+            self.all_co = get_verts_array(me, "co")
+            self.now_co = self.all_co[index]
+            if hide_vertices:
+                self.hide = get_verts_array(me, "hide", dtype = bool, size = 1)[index]
+
+    def write(self):
+        me = self.obj.data
+        index = self.index
+        if self.bm is not None:
+            set_bm_verts_co_array(self.bm, index, self.calc_co)
+            update_edit_mesh_coords(me, self.bm)
+        else:
+            self.all_co[index] = self.calc_co
+            set_verts_co_array(me, self.all_co)
+
 def register():
     bpy.utils.register_class(UndoVerticesUndoOperator)
 
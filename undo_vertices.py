@@ -11,50 +11,298 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import struct
+import uuid
+import weakref
+import zlib
+
+from bpy.app.handlers import persistent
 from .mesh_helpers import *
 from .grease_pencil_helpers import *
+from .helper import area_3d_view_tag_redraw_all
+from .usecase import remap_index
+from .snapshot import VerticesSnapshot, SnapshotGeometry, SnapshotStore
+
+# オブジェクトごとの保存データを識別するためのカスタムプロパティ名
+# 名前はリネームで変わるため、保存時に付与した一意なキーで識別する
+object_key_name = "undo_vertices_key"
+
+# キーの持ち主のオブジェクト (as_pointer)
+# 複製したオブジェクトはカスタムプロパティのキーも複製されるため、どちらが複製元かをセッション中に覚えておく
+object_key_owners = {}
+
+def get_object_key_owner(key):
+    """キーの持ち主のオブジェクトのポインタを取得する
+    覚えている持ち主がいない場合は、名前順で最初にキーを持つオブジェクト（複製元は複製より名前が先になる）を持ち主にする
+    """
+    pointer = object_key_owners.get(key)
+    objects = [other for other in bpy.data.objects if other.get(object_key_name) == key]
+    if pointer is None or all(other.as_pointer() != pointer for other in objects):
+        pointer = objects[0].as_pointer() if len(objects) > 0 else None
+        object_key_owners[key] = pointer
+    return pointer
+
+def get_object_key(obj, is_create = False):
+    """オブジェクトを識別するキーを取得する（is_create の場合は無ければ付与する）
+    複製で他のオブジェクトのキーを持っている場合は、複製した側のキーとして扱わず、is_create の場合は付け直す
+    """
+    if obj is None:
+        return None
+    key = obj.get(object_key_name)
+    pointer = obj.as_pointer()
+    if key is not None and object_key_owners.get(key) != pointer and get_object_key_owner(key) != pointer:
+        key = None
+    if key is None and is_create:
+        key = uuid.uuid4().hex
+        obj[object_key_name] = key
+        object_key_owners[key] = pointer
+    return key
+
+# 頂点を識別する整数の属性名
+# インデックスは頂点の削除や並べ替えで振り直されるため、保存時に付与した識別子で頂点を対応させる
+vertex_id_name = "undo_vertices_id"
+
+def get_vertex_id_lookup(ids):
+    """識別子から現在の頂点のインデックスを引く表を作る (O(n))
+    押し出しなどで識別子が複製された場合は、インデックスの小さい頂点を使う
+
+    :param ndarray ids 全頂点の識別子 (M,)  0以下は未付与
+    :return ndarray 識別子で参照できるインデックス  対応する頂点が無い場合は -1
+    """
+    index = np.flatnonzero(ids > 0)
+    lookup = np.full(int(ids.max(initial = 0)) + 1, -1, dtype = np.int32)
+    # 同じ位置へ代入した場合は後の値が残るため、逆順に代入してインデックスの小さい頂点を残す
+    index = index[::-1]
+    lookup[ids[index]] = index
+    return lookup
+
+def stamp_vertex_ids(obj, mask):
+    """保存する頂点のうち、識別子が未付与または他の頂点と重複している頂点に新しい識別子を付与する
+    編集モードの場合は事前にメッシュへ書き戻しておくこと
+
+    :param ndarray mask 保存する頂点 (M,) bool
+    :return ndarray 付与後の全頂点の識別子 (M,)
+    """
+    ids = get_verts_int_attribute_array(obj.data, vertex_id_name)
+    if ids is None:
+        ids = np.zeros(len(mask), dtype = np.int32)
+
+    # 識別子ごとに最もインデックスの小さい頂点だけが、その識別子を持っているとみなす
+    owner = np.zeros(len(ids), dtype = bool)
+    lookup = get_vertex_id_lookup(ids)
+    owner[lookup[lookup >= 0]] = True
+
+    stamp = np.flatnonzero(mask & ~owner)
+    if len(stamp) > 0:
+        start = int(ids.max(initial = 0)) + 1
+        ids[stamp] = np.arange(start, start + len(stamp), dtype = np.int32)
+        set_verts_int_attribute_array(obj, vertex_id_name, stamp, ids[stamp])
+    return ids
+
+def build_geometry_mod_timer():
+    # 作成を待っているオブジェクトごとに作成する（作成できなかったものは表示から再び要求される）
+    names = UndoVertices.geometry_mod_requests
+    UndoVertices.geometry_mod_requests = set()
+    for name in names:
+        obj = bpy.data.objects.get(name)
+        if obj is not None and obj.type == "MESH":
+            UndoVertices.build_geometry_mod(bpy.context, obj)
+    return None
+
+def get_snapshot_file_path():
+    """保存データを書き込むファイルのパス（.blendと同じフォルダに置く）未保存のファイルの場合はNone"""
+    if not bpy.data.filepath:
+        return None
+    return bpy.data.filepath + ".undo_vertices"
+
+@persistent
+def save_post_handler(*args):
+    """.blendの保存時に、保存データをファイルに書き込む"""
+    path = get_snapshot_file_path()
+    if path is None:
+        return
+    # 削除されたオブジェクトの保存データは書き込まない
+    object_keys = {obj.get(object_key_name) for obj in bpy.data.objects}
+    keys = [key for key in UndoVertices.store.keys() if key[0] in object_keys]
+    try:
+        if len(keys) > 0:
+            UndoVertices.store.save(path, keys)
+        elif os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        print("UndoVertices : failed to save snapshots", e)
+        # 以前の保存データのファイルが残っていると、次に開いたときに.blendと合わない保存データを読み込むため削除する
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print("UndoVertices : failed to remove old snapshots", e)
+
+@persistent
+def load_post_handler(*args):
+    """.blendの読み込み時に、ファイルから保存データを読み込む"""
+    UndoVertices.store.clear()
+    object_key_owners.clear()
+    path = get_snapshot_file_path()
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        UndoVertices.store.load(path)
+    except (OSError, ValueError, struct.error) as e:
+        UndoVertices.store.clear()
+        print("UndoVertices : failed to load snapshots", e)
+    area_3d_view_tag_redraw_all()
+    return None
 
 class UndoVertices():
     # 保存する頂点
     # annotation_point_name = "__UndoVerticesWorkingTemporaryAnnotationPoint__"
     # annotation_line_name = "__UndoVerticesWorkingTemporaryAnnotationLine__"
-    save_selected_verts = None
+    # オブジェクトとスロットごとの保存データ
+    store = SnapshotStore()
+    # 頂点数が増減した後に、保存データを現在の頂点へ対応させた結果（保存データごとに最後の1つだけ持つ）
+    # 保存データ自体は書き換えないため、Ctrl+Zで頂点が戻った場合も保存時の頂点にそのまま対応させられる
+    resolved_cache = weakref.WeakKeyDictionary()
+    # モディファイア適用有の形状の作成を待っているオブジェクト名
+    geometry_mod_requests = set()
     # save_selected_coords = []
     # save_selected_edge_coords = []
-    save_all_len = 0
     # annotation_layer_point = None
     # annotation_layer_line = None
-    save_bm = None
-    save_bm_mod = None
-    active_obj_name = None
+
+    @classmethod
+    def get_memory_budget(self):
+        """アドオンの設定から保存データのメモリの上限 (byte) を取得する"""
+        addon = bpy.context.preferences.addons.get(__package__)
+        if addon is None:
+            return 0
+        return addon.preferences.snapshot_memory_budget * 1024 * 1024
+
+    @classmethod
+    def get_slot_key(self, context = None, obj = None, is_create = False, slot = None):
+        """保存データのキー (オブジェクトのキー, スロット) を取得する（スロットの省略時は選択中のスロット）"""
+        context = context or bpy.context
+        obj = obj or context.view_layer.objects.active
+        object_key = get_object_key(obj, is_create)
+        if object_key is None:
+            return None
+        if slot is None:
+            slot = context.scene.undo_vertices_prop.save_slot
+        return (object_key, slot)
+
+    @classmethod
+    def get_snapshot(self, context = None, obj = None, slot = None):
+        """アクティブなオブジェクトの選択中のスロットの保存データを取得する"""
+        key = self.get_slot_key(context, obj, slot = slot)
+        return None if key is None else UndoVertices.store.get(key)
+
+    @classmethod
+    def get_object_slots(self, context = None):
+        """アクティブなオブジェクトの保存データの一覧を返す
+
+        :return list [(スロット, 頂点数, 使用メモリ, 共有しているメモリ), ...]
+        """
+        context = context or bpy.context
+        object_key = get_object_key(context.view_layer.objects.active)
+        return [(key[1], count, nbytes, shared) for key, count, nbytes, shared in UndoVertices.store.list() if key[0] == object_key]
 
     @classmethod
     def is_save(self):
-        return True if UndoVertices.save_selected_verts else False
+        return UndoVertices.get_len_save_verts() > 0
 
     @classmethod
-    def reset_save(self, context):
+    def reset_save(self, context, obj = None):
         # self.remove_annotation_layer(context)
-        self.save_selected_verts = None
+        key = self.get_slot_key(context, obj)
+        if key is not None:
+            UndoVertices.store.remove(key)
         # self.save_selected_coords = []
         # self.save_selected_edge_coords = []
-        self.save_all_len = 0
         # self.annotation_layer_point = None
         # self.annotation_layer_line = None
-        self.save_bm = None
-        self.save_bm_mod = None
+
+    @classmethod
+    def request_geometry_mod(self, interval = 0, obj = None):
+        """モディファイア適用有の形状が必要になったため、次のタイマーで作成する
+        描画ハンドラの中ではdepsgraphを評価できないため、タイマーに任せる
+
+        :param float interval 作成を試すまでの秒数（描画のたびに再試行する場合は間隔を空ける）
+        :param Object obj オブジェクト（省略時はアクティブなオブジェクト）
+        """
+        obj = obj or bpy.context.view_layer.objects.active
+        snapshot = self.get_snapshot(obj = obj)
+        if snapshot is None or snapshot.is_geometry_mod_pending == False:
+            return
+        UndoVertices.geometry_mod_requests.add(obj.name)
+        if not bpy.app.timers.is_registered(build_geometry_mod_timer):
+            bpy.app.timers.register(build_geometry_mod_timer, first_interval = interval)
+
+    @classmethod
+    def build_geometry_mod(self, context, obj = None):
+        """モディファイア適用有の形状を作成する
+        保存後に頂点や選択状態が変わっている場合は保存時の形状を再現できないため作成しない
+        作成できなかった場合は未作成のまま残し、保存時の状態に戻したときに表示から再び作成を試す
+
+        :param Object obj オブジェクト（省略時はアクティブなオブジェクト）
+        :return bool 作成したか
+        """
+        obj = obj or context.view_layer.objects.active
+        snapshot = self.get_snapshot(context, obj)
+        if snapshot is None or snapshot.is_geometry_mod_pending == False:
+            return False
+
+        # モディファイアが無い場合は適用無の形状と同じため、そのまま使う
+        if len(obj.modifiers) == 0:
+            snapshot.geometry_mod = snapshot.geometry
+            snapshot.is_geometry_mod_pending = False
+            return True
+
+        # 頂点数と選択数の比較で済む確認を先に行い、頂点の座標の比較はその後に行う
+        me = obj.data
+        if self.is_len_diff(obj) == False or me.total_vert_sel != len(snapshot):
+            return False
+        if obj.mode == "EDIT":
+            bm = bmesh.from_edit_mesh(me)
+            now_co = get_bm_verts_co_array(bm, snapshot.index)
+            is_selected = all(bm.verts[i].select for i in snapshot.index.tolist())
+        else:
+            now_co = get_verts_array(me, "co")[snapshot.index]
+            is_selected = get_verts_array(me, "select", dtype = bool, size = 1)[snapshot.index].all()
+        if is_selected == False or np.array_equal(now_co, snapshot.co) == False:
+            return False
+
+        snapshot.geometry_mod = SnapshotGeometry.from_evaluated(obj, context.evaluated_depsgraph_get())
+        snapshot.is_geometry_mod_pending = False
+        UndoVertices.store.evict()
+        area_3d_view_tag_redraw_all()
+        return True
 
     @classmethod
     def get_len_save_verts(self):
-        return 0 if self.save_selected_verts is None else len(self.save_selected_verts)
+        snapshot = self.get_snapshot()
+        return 0 if snapshot is None else len(snapshot)
+
+    @classmethod
+    def set_selected_verts(self, context, snapshot, obj = None, slot = None):
+        """オブジェクトの選択中のスロットに保存する"""
+        UndoVertices.store.budget = self.get_memory_budget()
+        UndoVertices.store.set(self.get_slot_key(context, obj, is_create = True, slot = slot), snapshot)
 
     @classmethod
-    def set_selected_verts(self, verts):
-        self.save_selected_verts = verts
+    def get_target_objects(self, context):
+        """処理対象のオブジェクトを取得する（複数オブジェクトの編集モードでは編集中の全てのメッシュ）"""
+        if context.mode == "EDIT_MESH":
+            return [obj for obj in context.objects_in_mode_unique_data if obj.type == "MESH"]
+        obj = context.active_object
+        return [obj] if obj is not None and obj.type == "MESH" else []
 
     @classmethod
-    def get_selected_verts(self, bm):
-        return [(v.co.copy(), v.normal.copy(), v.index) for v in bm.verts if v.select]
+    def get_selected_verts(self, obj, mask = None):
+        # 選択状態の読み込み時に編集モードの変更をメッシュに書き戻しているので、そのまま配列でまとめて読み込む
+        if mask is None:
+            mask = get_verts_select_array(obj)
+        return VerticesSnapshot.from_mesh(obj.data, mask)
 
     # @classmethod
     # def set_selected_coords(self, bm, obj):
@@ -131,43 +379,180 @@ class UndoVertices():
     #         self.annotation_layer_line.hide = False == (prop.is_view and prop.is_view_line)
 
     @classmethod
-    def is_len_diff(self):
-        bm = bmesh_from_object(bpy.context.active_object)
-        return self.save_all_len == len(bm.verts)
+    def is_len_diff(self, obj = None, slot = None):
+        obj = obj or bpy.context.active_object
+        snapshot = self.get_snapshot(obj = obj, slot = slot)
+        return snapshot is not None and snapshot.all_len == get_verts_len(obj)
+
+    @classmethod
+    def get_remapped_snapshot(self, snapshot, remap, all_len):
+        """保存した頂点ごとの現在のインデックスから、現在の頂点に対応させた一時的な保存データを作る
+
+        :param ndarray remap 保存した頂点ごとの現在のインデックス (N,)  対応する頂点が無い場合は -1
+        :param int all_len 現在の全頂点数
+        :return VerticesSnapshot
+        """
+        # 対応した頂点だけを現在のインデックス順に並べ直す
+        slots = np.flatnonzero(remap >= 0)
+        slots = slots[np.argsort(remap[slots], kind = "stable")]
+        ids = None if snapshot.ids is None else snapshot.ids[slots]
+        remapped = VerticesSnapshot(remap[slots].astype(np.int32), snapshot.co[slots], snapshot.normal[slots], ids)
+        remapped.all_len = all_len
+        # 表示用の形状は保存時のまま使う
+        remapped.geometry = snapshot.geometry
+        remapped.geometry_mod = snapshot.geometry_mod
+        return remapped
+
+    @classmethod
+    def remap_snapshot(self, context, obj, snapshot):
+        """頂点数が増減した後の保存データを、保存した座標と辺をもとに現在の頂点へ対応させる
+        保存データは書き換えず、対応させた一時的な保存データを返す（現在の頂点が同じ間は同じものを返す）
+
+        :return tuple (対応させた保存データ, 辺で確認して対応させた頂点数, 近傍を探索して対応させた頂点数)
+        """
+        prop = context.scene.undo_vertices_prop
+        if obj.mode == "EDIT":
+            obj.update_from_editmode()
+        me = obj.data
+        now_co = get_verts_array(me, "co")
+        now_edges = get_edges_array(me)
+
+        # 元に戻すの再実行では頂点が同じため、前回の対応をそのまま使う
+        key = ("CO", prop.remap_distance, zlib.crc32(now_co.data), zlib.crc32(np.ascontiguousarray(now_edges).data))
+        cache = self.resolved_cache.get(snapshot)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        save_edges = None if snapshot.geometry is None else snapshot.geometry.edges
+        remap, linked, searched = remap_index(snapshot.index, snapshot.co, save_edges, now_co, now_edges, snapshot.all_len, prop.remap_distance)
+        result = (self.get_remapped_snapshot(snapshot, remap, len(now_co)), int(np.count_nonzero(linked)), int(np.count_nonzero(searched)))
+        self.resolved_cache[snapshot] = (key, result)
+        return result
+
+    @classmethod
+    def remap_snapshot_by_ids(self, snapshot, ids):
+        """頂点の並びが変わった後の保存データを、識別子で現在の頂点に対応させる (O(n))
+        保存データは書き換えず、対応させた一時的な保存データを返す（現在の識別子が同じ間は同じものを返す）
+
+        :param ndarray ids 現在の全頂点の識別子 (M,)
+        :return VerticesSnapshot
+        """
+        key = ("IDS", zlib.crc32(np.ascontiguousarray(ids).data))
+        cache = self.resolved_cache.get(snapshot)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        lookup = get_vertex_id_lookup(ids)
+        save_ids = snapshot.ids
+        remap = np.full(len(save_ids), -1, dtype = np.int32)
+        valid = save_ids < len(lookup)
+        remap[valid] = lookup[save_ids[valid]]
+        remapped = self.get_remapped_snapshot(snapshot, remap, len(ids))
+        self.resolved_cache[snapshot] = (key, remapped)
+        return remapped
+
+    @classmethod
+    def is_ids_match(self, obj, snapshot):
+        """保存した頂点のインデックスにある頂点の識別子が保存時と同じか（保存した頂点数分だけ確認する）"""
+        if obj.mode == "EDIT":
+            bm = bmesh.from_edit_mesh(obj.data)
+            if len(snapshot) > 0 and snapshot.index[-1] >= len(bm.verts):
+                return False
+            now_ids = get_bm_verts_int_layer_array(bm, vertex_id_name, snapshot.index)
+        else:
+            if len(snapshot) > 0 and snapshot.index[-1] >= len(obj.data.vertices):
+                return False
+            now_ids = get_verts_int_attribute_array(obj.data, vertex_id_name)
+            now_ids = None if now_ids is None else now_ids[snapshot.index]
+        return now_ids is not None and np.array_equal(now_ids, snapshot.ids)
+
+    @classmethod
+    def resolve_snapshot(self, context, obj, report, slot = None):
+        """保存データを現在の頂点に対応させる
+
+        識別子がある場合は、頂点の削除や並べ替えがあっても識別子で対応させ直す
+        識別子が無い場合は、頂点数が増減していなければそのまま使い、増減していれば設定に応じて座標と辺から対応させる
+
+        :param function report オペレーターの report
+        :param int slot スロット（省略時は選択中のスロット）
+        :return VerticesSnapshot 現在の頂点に対応させた保存データ（使えない場合はNone）
+        """
+        snapshot = self.get_snapshot(context, obj, slot)
+        if snapshot is None:
+            return None
+
+        ids = None
+        if snapshot.ids is not None:
+            # 保存した頂点の並びが変わっていない場合は、そのまま使う
+            if self.is_ids_match(obj, snapshot):
+                return snapshot
+            if obj.mode == "EDIT":
+                obj.update_from_editmode()
+            ids = get_verts_int_attribute_array(obj.data, vertex_id_name)
+
+        if ids is not None:
+            remapped = self.remap_snapshot_by_ids(snapshot, ids)
+            matched, total = len(remapped), len(snapshot)
+            report({"INFO"}, "頂点を対応させ直しました : %s %d / %d (%.1f%%)" % (obj.name, matched, total, 100 * matched / max(total, 1)))
+            return remapped if matched > 0 else None
+
+        if self.is_len_diff(obj, slot):
+            return snapshot
+        if context.scene.undo_vertices_prop.is_remap == False:
+            return None
+
+        # 座標による対応は、座標で確認できた頂点以外は確実ではないため警告として伝える
+        remapped, linked, searched = self.remap_snapshot(context, obj, snapshot)
+        matched, total = len(remapped), len(snapshot)
+        message = "頂点を座標で対応させ直しました : %s %d / %d (位置で確認 %d, 辺で確認 %d, 近傍を探索 %d, 対応無し %d)" % (
+            obj.name, matched, total, matched - linked - searched, linked, searched, total - matched)
+        if searched > 0:
+            message += " 近傍を探索した頂点は誤っている可能性があります"
+        report({"INFO"} if searched == 0 and matched == total else {"WARNING"}, message)
+        return remapped if matched > 0 else None
 
     @classmethod
-    def select_save_verts(self, context, obj):
+    def select_save_verts(self, context, obj, snapshot = None):
+        """保存した頂点を選択する
+
+        :param VerticesSnapshot snapshot 現在の頂点に対応させた保存データ（省略時は選択中のスロットの保存データ）
+        """
         prop = context.scene.undo_vertices_prop
-        bm = bmesh_from_object(obj)
-        bm.select_flush(True)
-        bm.verts.ensure_lookup_table()
+        snapshot = snapshot or self.get_snapshot(context, obj)
+
+        # 現在の選択状態をまとめて読み込み、保存した頂点との選択状態の組み合わせを配列の演算で求める
+        current = get_verts_select_array(obj)
+        saved = np.zeros(len(current), dtype = bool)
+        saved[snapshot.index] = True
 
         # 保存した頂点のみ選択する
         if prop.select == "SELECT_SET":
-            for v in bm.verts:
-                v.select = False
-            for v in self.save_selected_verts:
-                index = v[2]
-                bm.verts[index].select = True
+            mask = saved
 
         # 保存した頂点を追加選択する
         elif prop.select == "SELECT_EXTEND":
-            for v in self.save_selected_verts:
-                index = v[2]
-                bm.verts[index].select = True
+            mask = current | saved
 
         # 保存した頂点を対象に選択を解除する
         elif prop.select == "SELECT_SUBTRACT":
-            for v in self.save_selected_verts:
-                index = v[2]
-                bm.verts[index].select = False
+            mask = current & ~saved
 
-        # # 保存済の頂点を対象に選択状態を反転する
+        # 保存済の頂点を対象に選択状態を反転する
         elif prop.select == "SELECT_DIFFERENCE":
-            for v in self.save_selected_verts:
-                index = v[2]
-                # 選択したものに対して選択状態を反転する
-                bm.verts[index].select = bm.verts[index].select != True
-            
-        bm.select_flush_mode()
-        bmesh.update_edit_mesh(obj.data)
\ No newline at end of file
+            mask = current ^ saved
+
+        # 選択状態が変わる頂点だけを書き込み、最後に一度だけ辺と面へ反映する
+        set_verts_select_array(obj, mask, current)
+
+
+def register():
+    bpy.app.handlers.save_post.append(save_post_handler)
+    bpy.app.handlers.load_post.append(load_post_handler)
+    # アドオンの再読み込み時は開いているファイルの保存データを読み込み直す（登録中はbpy.dataを参照できないため、タイマーに任せる）
+    bpy.app.timers.register(load_post_handler, first_interval = 0)
+
+def unregister():
+    if save_post_handler in bpy.app.handlers.save_post:
+        bpy.app.handlers.save_post.remove(save_post_handler)
+    if load_post_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(load_post_handler)
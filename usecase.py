@@ -15,77 +15,247 @@ import math
 import numpy as np
 
 from pprint import pprint
+from mathutils.kdtree import KDTree
 from .helper import *
 
-def get_curve_map_locations(mod, curve_late):
-    curve_map = mod.falloff_curve
-    curves = curve_map.curves[0]
-    map_x = []
-    map_y = []
-    for i, p in enumerate(curves.points):
-        location = curves.points[i].location
-        map_x.append(location[0])
-        map_y.append(location[1] * curve_late)
-    return (map_x, map_y)
-
-def get_distance(verts, bm, roughness, fixed = None):
-    # 移動距離を算出し、変化した量で並べる
-    distance = []
-    if fixed is None:
-        for v in verts:
-            save_co = v[0]
-            index = v[2]
-            now_co = bm.verts[index].co
-            x1 = save_co.x
-            y1 = save_co.y
-            z1 = save_co.z
-            x2 = now_co.x
-            y2 = now_co.y
-            z2 = now_co.z
-            if x1 == x2 and y1 == y2 and z1 == z2:
-                distance.append((0, index))
-            else:
-                distance.append((distance_3d(x1, y1, z1, x2, y2, z2), index))
-
-    # 固定座標からの移動量で評価する
-    else:
-        for v in verts:
-            index = v[2]
-            now_co = bm.verts[index].co
-            x1 = fixed[0]
-            y1 = fixed[1]
-            z1 = fixed[2]
-            x2 = now_co.x
-            y2 = now_co.y
-            z2 = now_co.z
-            if x1 == x2 and y1 == y2 and z1 == z2:
-                distance.append((0, index))
-            else:
-                distance.append((distance_3d(x1, y1, z1, x2, y2, z2), index))
-
-    # 最も大きな移動量を持つものを1として並び変える
-    distance = sorted(distance)
-    distance_sort = []
-    total = len(distance)
-    for i, d in enumerate(distance):
-        dis = d[0]
-        index = d[1]
-        # 移動量が無い場合は変化量を0にする
-        if dis == 0:
-            distance_sort.append((0, index))
-        
-        # 初回ではない かつ 前回と移動量は変化量を同じにする
-        elif i != 0:
-            bf_dis = distance[i - 1][0]
-            # 移動量の差に対して粗さをつけて判断する
-            if abs(dis - bf_dis) <= roughness:
-                distance_sort.append((distance_sort[-1][0], index))
-            else:
-                distance_sort.append(((i + 1) / total, index))
-        else:
-            distance_sort.append(((i + 1) / total, index))
-
-    return distance_sort
+# カーブを評価する表の大きさ（保存した頂点数に関係なく一定）
+FALLOFF_TABLE_SIZE = 256
+
+def get_curve_map_table(curve_map, curve_late, segment = FALLOFF_TABLE_SIZE):
+    """カーブマッピングを一定の数の位置で評価した表を作る
+    制御点のx座標の位置も含めて、UIに表示されている曲線そのものを評価する
+
+    :return tuple (x, y) それぞれ (segment,)
+    """
+    curve_map.initialize()
+    curve = curve_map.curves[0]
+    map_x = np.linspace(0, 1, segment)
+    map_y = np.fromiter((curve_map.evaluate(curve, x) for x in map_x.tolist()), dtype = np.float64, count = segment)
+    return (map_x, map_y * curve_late)
+
+def evaluate_falloff(ranks, table):
+    """順位ごとの変更率を表から補間して求める
+
+    :param ndarray ranks 順位 0 ~ 1 (N,)
+    :param tuple table get_curve_map_table の戻り値
+    :return ndarray (N,)
+    """
+    return np.interp(ranks, table[0], table[1])
+
+def calc_undo_coords(save_co, now_co, rate, lock_axiz, is_undo = False, hide = None):
+    """保存した座標と現在の座標を変更率で補間した座標を配列で求める
+
+    :param ndarray save_co 保存した座標 (N, 3)
+    :param ndarray now_co 現在の座標 (N, 3)
+    :param float|ndarray rate 変更率 0 ~ 1 (全頂点で共通の値、または頂点ごとの (N,))
+    :param set lock_axiz 固定する軸 {"X", "Y", "Z"}
+    :param bool is_undo 完全に元に戻すか
+    :param ndarray hide 保存した座標に戻す頂点 (N,) bool
+    :return ndarray (N, 3)
+    """
+    if is_undo:
+        return save_co.copy()
+
+    calc_co = get_coords_calc_two_point(save_co, now_co, rate)
+
+    # 固定した軸は保存した座標に戻す
+    lock = [axis in lock_axiz for axis in ("X", "Y", "Z")]
+    if any(lock):
+        calc_co[:, lock] = save_co[:, lock]
+
+    # 非表示の頂点は保存した座標に戻す
+    if hide is not None:
+        calc_co[hide] = save_co[hide]
+
+    return calc_co
+
+def get_distance(save_co, now_co, roughness, fixed = None):
+    """保存した頂点ごとの移動量の順位を 0 ~ 1 で求める
+
+    :param ndarray save_co 保存した座標 (N, 3)
+    :param ndarray now_co 現在の座標 (N, 3)
+    :param float roughness 同じ順位とみなす移動量の差
+    :param Vector fixed 固定座標からの移動量で評価する場合の座標
+    :return ndarray 保存した頂点の並び順 (スロット) で参照できる順位 (N,)
+    """
+    total = len(now_co)
+    ranks = np.zeros(total, dtype = np.float64)
+    if total == 0:
+        return ranks
+
+    # 移動距離を算出する（固定座標がある場合は固定座標からの移動量で評価する）
+    origin = save_co if fixed is None else np.asarray(fixed, dtype = np.float64)
+    distance = np.linalg.norm(now_co.astype(np.float64) - origin, axis = 1)
+
+    # 変化した量で並べる
+    order = np.argsort(distance, kind = "stable")
+    distance = distance[order]
+
+    # 移動量が無い位置、前回との移動量の差が粗さを超える位置で順位を区切る
+    is_start = np.empty(total, dtype = bool)
+    is_start[0] = True
+    is_start[1:] = np.abs(np.diff(distance)) > roughness
+    is_start |= distance == 0
+
+    # 区切った位置の順位を後続の頂点に引き継ぐ（最も大きな移動量を持つものが1になる）
+    start = np.maximum.accumulate(np.where(is_start, np.arange(total), 0))
+    # 移動量が無い場合は変化量を0にする
+    ranks[order] = np.where(distance[start] == 0, 0, (start + 1) / total)
+    return ranks
+
+def create_kdtree(co, index = None):
+    """座標からKDツリーを作る
+
+    :param ndarray co 座標 (N, 3)
+    :param ndarray index 検索結果として返すインデックス (N,)  省略時は並び順
+    """
+    kd = KDTree(len(co))
+    labels = range(len(co)) if index is None else index.tolist()
+    for i, v_co in zip(labels, co.tolist()):
+        kd.insert(v_co, i)
+    kd.balance()
+    return kd
+
+def find_nearest_index(kd, co):
+    """座標ごとに最も近い点のインデックスをKDツリーから探す
+
+    :param ndarray co 探す座標 (M, 3)
+    :return ndarray (M,) int32
+    """
+    find = kd.find
+    return np.fromiter((find(v_co)[1] for v_co in co.tolist()), dtype = np.int32, count = len(co))
+
+def get_adjacency(edges, count):
+    """辺から頂点ごとの隣接頂点を引く表を作る
+
+    :param ndarray edges 辺の頂点の組 (E, 2)
+    :param int count 頂点数
+    :return tuple (頂点ごとの隣接頂点の開始位置 (count + 1,), 隣接頂点 (2E,))  頂点 i の隣接頂点は adjacent[start[i]:start[i + 1]]
+    """
+    edges = np.asarray(edges, dtype = np.int64).reshape(-1, 2)
+    source = np.concatenate([edges[:, 0], edges[:, 1]])
+    adjacent = np.concatenate([edges[:, 1], edges[:, 0]])
+    start = np.zeros(count + 1, dtype = np.int64)
+    np.cumsum(np.bincount(source, minlength = count), out = start[1:])
+    return start, adjacent[np.argsort(source, kind = "stable")]
+
+def remap_index(save_index, save_co, save_edges, now_co, now_edges, save_all_len, distance, k = 8):
+    """頂点数が増減した後の、保存した頂点に対応する現在の頂点のインデックスを求める
+
+    1. 保存時のインデックスの頂点が保存した座標の近くにある場合はそのまま対応させる
+       頂点の削除があるとインデックスは詰められるため、座標で確認できない頂点はインデックスだけでは対応させない
+    2. 保存後に動かした頂点は座標で確認できないため、対応済みの頂点から保存時の辺をたどって確認する
+       保存時のインデックスの頂点が、辺で繋がっていた頂点の対応先と現在も繋がっている（ループカットで辺が分割された場合は1つ挟んで繋がっている）場合に対応させる
+    3. 対応しなかった頂点は、保存した座標から最も近い未対応の頂点をKDツリーで探す
+    4. それでも対応しなかった頂点は、辺で繋がっていた頂点の対応先の隣接頂点から、保存時の相対的な位置に最も近いものを選ぶ
+       3 と 4 は近くにある別の頂点に対応する場合があるため、確実な対応ではない
+
+    :param ndarray save_index 保存した頂点のインデックス (N,)
+    :param ndarray save_co 保存した座標 (N, 3)
+    :param ndarray save_edges 保存した頂点の間の辺 (F, 2)  save_co の並びを参照する  無い場合はNone
+    :param ndarray now_co 現在の全頂点の座標 (M, 3)
+    :param ndarray now_edges 現在の全ての辺の頂点の組 (E, 2)
+    :param int save_all_len 保存時の全頂点数
+    :param float distance 対応させる頂点との距離の上限
+    :param int k KDツリーで探す候補の数
+    :return tuple (保存した頂点ごとの現在のインデックス (N,)  対応する頂点が無い場合は -1,
+                   辺で確認して対応させた頂点 (N,) bool,
+                   KDツリーや隣接頂点から探して対応させた頂点 (N,) bool)
+    """
+    total = len(now_co)
+    remap = np.full(len(save_index), -1, dtype = np.int32)
+    linked = np.zeros(len(save_index), dtype = bool)
+    searched = np.zeros(len(save_index), dtype = bool)
+    claimed = np.zeros(total, dtype = bool)
+    in_range = save_index < min(total, save_all_len)
+
+    # 保存時のインデックスの頂点が保存した座標にある場合のみ対応させる
+    valid = np.flatnonzero(in_range)
+    near = np.linalg.norm(now_co[save_index[valid]] - save_co[valid], axis = 1) <= distance
+    valid = valid[near]
+    remap[valid] = save_index[valid]
+    claimed[save_index[valid]] = True
+
+    has_topology = save_edges is not None and len(save_edges) > 0 and len(now_edges) > 0
+    if has_topology:
+        save_edges = np.asarray(save_edges, dtype = np.int64).reshape(-1, 2)
+        save_edges = np.concatenate([save_edges, save_edges[:, ::-1]])
+        now_start, now_adjacent = get_adjacency(now_edges, total)
+        now_edges = np.asarray(now_edges, dtype = np.int64).reshape(-1, 2)
+        now_keys = np.unique(np.minimum(now_edges[:, 0], now_edges[:, 1]) * total + np.maximum(now_edges[:, 0], now_edges[:, 1]))
+
+    def link_by_index():
+        """対応済みの頂点と辺で繋がっていた頂点を、保存時のインデックスのまま辺で確認して対応させる"""
+        count = 0
+        while True:
+            frontier = save_edges[(remap[save_edges[:, 0]] >= 0) & (remap[save_edges[:, 1]] < 0)]
+            frontier = frontier[in_range[frontier[:, 1]]]
+            if len(frontier) == 0:
+                return count
+            frontier = frontier[~claimed[save_index[frontier[:, 1]]]]
+            anchor = remap[frontier[:, 0]].astype(np.int64)
+            target = save_index[frontier[:, 1]].astype(np.int64)
+            keys = np.minimum(anchor, target) * total + np.maximum(anchor, target)
+            is_linked = np.isin(keys, now_keys)
+            # 直接繋がっていない組は、間に1つ頂点を挟んで繋がっているかを確認する
+            for i in np.flatnonzero(~is_linked).tolist():
+                a, t = anchor[i], target[i]
+                is_linked[i] = len(np.intersect1d(now_adjacent[now_start[a]:now_start[a + 1]], now_adjacent[now_start[t]:now_start[t + 1]])) > 0
+            slots = np.unique(frontier[is_linked, 1])
+            if len(slots) == 0:
+                return count
+            remap[slots] = save_index[slots]
+            claimed[save_index[slots]] = True
+            linked[slots] = True
+            count += len(slots)
+
+    def link_by_neighbor():
+        """対応済みの頂点と辺で繋がっていた頂点を、対応先の隣接頂点から保存時の相対的な位置で探して対応させる"""
+        count = 0
+        frontier = save_edges[(remap[save_edges[:, 0]] >= 0) & (remap[save_edges[:, 1]] < 0)]
+        for slot, neighbor in frontier[:, ::-1].tolist():
+            if remap[slot] >= 0:
+                continue
+            anchor = remap[neighbor]
+            candidates = now_adjacent[now_start[anchor]:now_start[anchor + 1]]
+            candidates = candidates[~claimed[candidates]]
+            if len(candidates) == 0:
+                continue
+            offset = save_co[slot] - save_co[neighbor]
+            error = np.linalg.norm(now_co[candidates] - (now_co[anchor] + offset), axis = 1)
+            best = int(np.argmin(error))
+            # 保存時の辺の長さの半分より離れている場合は別の頂点とみなす
+            if error[best] <= max(distance, 0.5 * float(np.linalg.norm(offset))):
+                remap[slot] = candidates[best]
+                searched[slot] = True
+                claimed[candidates[best]] = True
+                count += 1
+        return count
+
+    if has_topology:
+        link_by_index()
+
+    # 残りは未対応の頂点だけで作ったKDツリーから探す
+    missing = np.flatnonzero(remap < 0)
+    candidates = np.flatnonzero(~claimed)
+    if len(missing) > 0 and len(candidates) > 0:
+        kd = create_kdtree(now_co[candidates], candidates)
+        for slot, co in zip(missing.tolist(), save_co[missing].tolist()):
+            for _, index, dist in kd.find_n(co, k):
+                if dist > distance:
+                    break
+                if not claimed[index]:
+                    remap[slot] = index
+                    searched[slot] = True
+                    claimed[index] = True
+                    break
+
+    # 探して対応した頂点からも辺をたどり、対応が増えなくなるまで繰り返す
+    if has_topology:
+        while link_by_index() + link_by_neighbor() > 0:
+            pass
+
+    return remap, linked, searched
 
 # curve_name = "__UndoVerticesWorkingTemporaryCurve__"
 
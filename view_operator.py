@@ -14,12 +14,31 @@
 import bpy
 import gpu
 import bgl
+import numpy as np
 from gpu_extras.batch import batch_for_shader
 from bpy.types import Operator
 from .undo_vertices import UndoVertices
 
 from .helper import *
 
+def create_point_buffers(geometry):
+    """点の描画に使う頂点バッファを作る (GPUを使わないためバックグラウンドでも確認できる)
+    読み込んだ保存データの配列はメモリマップのため、そのまま持つとファイルを置き換えられなくなる。必ずコピーする
+
+    :return dict {"pos" : (N, 3) float32}
+    """
+    return {"pos" : np.array(geometry.co, dtype = np.float32, order = "C")}
+
+def create_line_buffers(geometry, view_z):
+    """視点から見て法線が外側を向いている辺だけの頂点インデックスを作る
+
+    :param Vector view_z 視点の回転行列のZ軸
+    :return ndarray (E, 2) int32
+    """
+    # 3DVIEWから見て、法線の向きが内側である辺を一度の内積で除く
+    view_z = np.array(view_z, dtype = np.float32)
+    return np.ascontiguousarray(geometry.edges[geometry.edge_normals @ view_z >= 0])
+
 class UndoVerticesViewOperator(Operator, UndoVertices):
     bl_idname = "view_verts.operator"
     bl_label = "Undo Vertices Save Vertices"
@@ -27,6 +46,50 @@ class UndoVerticesViewOperator(Operator, UndoVertices):
     # 描画ハンドラ
     draw_handler = None
 
+    # 描画用のキャッシュ（保存時、またはモディファイア有無の切り替えで形状が変わったときのみ作り直す）
+    shader = None
+    batch_geometry = None
+    point_buffers = None
+    point_batch = None
+    # 辺のバッチは視点ごとに異なるため、3DVIEWの領域ごとに (視点の回転, インデックス, バッチ) を持つ
+    line_cache = {}
+
+    @classmethod
+    def update_batch_cache(self, geometry):
+        """形状が変わっている場合のみバッファとバッチを作り直す"""
+        if self.batch_geometry is geometry:
+            return
+        if self.shader is None:
+            self.shader = gpu.shader.from_builtin("3D_UNIFORM_COLOR")
+        self.point_buffers = create_point_buffers(geometry)
+        self.point_batch = batch_for_shader(self.shader, "POINTS", self.point_buffers)
+        self.batch_geometry = geometry
+        self.line_cache = {}
+
+    @classmethod
+    def update_line_batch_cache(self, geometry, region_data):
+        """視点の回転が前回の描画から変わっている場合のみ辺のバッチを作り直す"""
+        key = region_data.as_pointer()
+        view_rotation = region_data.view_rotation.copy()
+        cache = self.line_cache.get(key)
+        if cache is not None and cache[0] == view_rotation:
+            return cache[2]
+
+        view_z = view_rotation.to_matrix().col[2]
+        indices = create_line_buffers(geometry, view_z)
+        batch = None
+        if len(indices) > 0:
+            batch = batch_for_shader(self.shader, "LINES", self.point_buffers, indices = indices)
+        self.line_cache[key] = (view_rotation, indices, batch)
+        return batch
+
+    @classmethod
+    def clear_batch_cache(self):
+        self.batch_geometry = None
+        self.point_buffers = None
+        self.point_batch = None
+        self.line_cache = {}
+
     @classmethod
     def is_enable(self):
         # 描画ハンドラがNone以外のときは描画中であるため、Trueを返す
@@ -36,6 +99,7 @@ class UndoVerticesViewOperator(Operator, UndoVertices):
     def force_disable(self):
         bpy.types.SpaceView3D.draw_handler_remove(self.draw_handler, "WINDOW")
         self.draw_handler = None
+        self.clear_batch_cache()
         area_3d_view_tag_redraw_all()
 
     @classmethod
@@ -46,6 +110,7 @@ class UndoVerticesViewOperator(Operator, UndoVertices):
     def __handle_remove(self, context):
         bpy.types.SpaceView3D.draw_handler_remove(self.draw_handler, "WINDOW")
         self.draw_handler = None
+        self.clear_batch_cache()
 
     @classmethod
     def __draw(self, context):
@@ -56,41 +121,35 @@ class UndoVerticesViewOperator(Operator, UndoVertices):
         if prop.is_view_point == False and prop.is_view_line == False:
             return
 
-        # モディファイア有無の表示切り替えによって使用するbmを変える
+        # モディファイア有無の表示切り替えによって使用する形状を変える
+        # モディファイア適用有の形状が未作成の場合は適用無の形状で代用する
+        snapshot = UndoVertices.get_snapshot()
+        if snapshot is None:
+            return
+        geometry = None
         if prop.is_modifier :
-            bm = UndoVertices.save_bm_mod
-        else :
-            bm = UndoVertices.save_bm
-        coords = [v.co.copy() for v in bm.verts]
+            geometry = snapshot.geometry_mod
+            # 保存時の状態と異なり作成できなかった場合は、保存時の状態に戻ったときに作成できるよう間隔を空けて再試行する
+            if geometry is None :
+                UndoVertices.request_geometry_mod(interval = 0.5)
+        if geometry is None :
+            geometry = snapshot.geometry
+        self.update_batch_cache(geometry)
 
         bgl.glEnable(bgl.GL_BLEND)
         bgl.glLineWidth(7)
 
-        shader = gpu.shader.from_builtin("3D_UNIFORM_COLOR")
+        shader = self.shader
         shader.bind()
         if prop.is_view_point :
             shader.uniform_float("color", (0, 1, 1, 1))
-            batch = batch_for_shader(shader, "POINTS", {"pos" : coords})
-            batch.draw(shader)
+            self.point_batch.draw(shader)
 
         if prop.is_view_line :
-            indices = []
-    
-            for e in bm.edges:
-                v1 = e.verts[0]
-                v2 = e.verts[1]
-                normal = v1.normal + v2.normal
-
-                # 3DVIEWから見て、法線の向きが内側であるか
-                if is_in_normal_from_view_3d(context, normal):
-                    continue
-                indices.append((v1.index, v2.index))
-
-            # bm.free() # freeにすると保存した情報が消える
-
-            shader.uniform_float("color", (0, 1, 1, 0.2))
-            batch = batch_for_shader(shader, 'LINES', {"pos": coords}, indices = indices)
-            batch.draw(shader)
+            batch = self.update_line_batch_cache(geometry, bpy.context.region_data)
+            if batch is not None:
+                shader.uniform_float("color", (0, 1, 1, 0.2))
+                batch.draw(shader)
 
         bgl.glDisable(bgl.GL_BLEND)
 